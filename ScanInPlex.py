@@ -2,22 +2,22 @@ import argparse
 import os
 import ScanInPlexCommon as Common
 from ScanInPlexConfiguration import Configure
+from ScanInPlexNotifications import NotificationListener
 from ScanInPlexUninstaller import Uninstall
 from ScanInPlexScanner import Scanner
+from ScanInPlexService import Service
+from ScanInPlexSnapshot import Exporter
+from ScanInPlexTrace import summarize
+from ScanInPlexWatcher import Watcher
 
 class ScanInPlexRouter:
     def __init__(self):
         self.valid = True
-        if os.name.lower() != 'nt':
-            self.valid = False
-            print_error(f'os "{os.name}" detected, Windows required.')
-            os.system('pause')
-            return
 
     def run(self):
         if not self.valid:
             return
-        parser = argparse.ArgumentParser(usage='ScanInPlex.py [-h] [-c [-p HOST] [-t TOKEN] [-w] [-v | -q]] | [-s -d DIR] | -u [-q]')
+        parser = argparse.ArgumentParser(usage='ScanInPlex.py [-h] [-c [-p HOST] [-t TOKEN] [-w] [-v | -q]] | [-s (-d DIR [-d DIR ...] | --from-file FILE) [--fan_out N] [--dry_run] [--wait]] | --watch [--settle SECONDS] [--poll SECONDS] [--max_scans N] [-q] | --serve [--listen HOST:PORT | --socket PATH] [-q] | --notifications [-q] | --export DIR [-q] | --stats | -u [-q]')
         parser.add_argument('-c', '--configure', action="store_true", help="Configure ScanInPlex")
         parser.add_argument('-p', '--host', help='Plex host (e.g. http://localhost:32400)')
         parser.add_argument('-t', '--token', help='Plex token')
@@ -27,26 +27,69 @@ class ScanInPlexRouter:
         parser.add_argument('-q', '--quiet', action='store_true', help='Only show error messages')
 
         parser.add_argument('-s', '--scan', help='Scan a folder in Plex', action="store_true")
-        parser.add_argument('-d', '--directory', help='Folder to scan')
+        parser.add_argument('-d', '--directory', action='append', help='Folder to scan. Can be given multiple times')
+        parser.add_argument('--from-file', dest='from_file', help='File listing folders to scan, one per line. "-" reads them from stdin')
+        parser.add_argument('--fan_out', type=int, help='Scan the parent folder instead when more than this many of its subfolders are given (default: scan_fan_out from config.yml, 10). 0 to disable')
+        parser.add_argument('--dry_run', action='store_true', help='Print what would be scanned instead of scanning it')
         parser.add_argument('--refresh_metadata', action='store_true', help='Refresh metadata for a folder instead of scanning')
+        parser.add_argument('--refresh_strategy', choices=['auto', 'forced-path', 'per-item'], help='How to refresh metadata (default: refresh_strategy from config.yml, per-item)')
+        parser.add_argument('--wait', action='store_true', help='Wait for the scan to finish and report how long it took')
+
+        parser.add_argument('--watch', action='store_true', help='Watch library folders for changes and scan them automatically')
+        parser.add_argument('--settle', type=float, default=30, help='Seconds to wait after the last change before scanning (default: 30)')
+        parser.add_argument('--poll', type=float, default=60, help='Seconds between checks for changes when OS notifications aren\'t available (default: 60)')
+        parser.add_argument('--max_scans', type=int, default=10, help='Maximum number of folders to scan at once. Deeper folders are combined into their parents beyond this (default: 10)')
+
+        parser.add_argument('--serve', action='store_true', help='Run as a service that accepts scan and refresh requests over HTTP. Also works outside of Windows')
+        parser.add_argument('--listen', default='127.0.0.1:32500', help='Address to accept requests on in --serve mode (default: 127.0.0.1:32500)')
+        parser.add_argument('--socket', help='Accept requests on this Unix socket instead of --listen')
+
+        parser.add_argument('--notifications', action='store_true', help='Keep the library folders and the item index used by refreshes up to date using the notifications Plex sends')
+
+        parser.add_argument('--export', metavar='DIR', help='Write a snapshot of every library\'s items to DIR, for other machines to seed their refresh index from (see snapshot_path)')
+
+        parser.add_argument('--stats', action='store_true', help='Summarize how long each phase of scans and refreshes took, based on the trace log')
 
         parser.add_argument('-u', '--uninstall', action="store_true", help='Uninstall Scan in Plex (delete regkeys)')
 
         cmd_args = parser.parse_args()
-        count = sum([1 if arg else 0 for arg in [cmd_args.configure, cmd_args.scan, cmd_args.uninstall]])
+        count = sum([1 if arg else 0 for arg in [cmd_args.configure, cmd_args.scan, cmd_args.watch, cmd_args.serve, cmd_args.notifications, cmd_args.export, cmd_args.stats, cmd_args.uninstall]])
         if count > 1:
-            print_error('Cannot specify multiple top-level commands (configure, scan, uninstall)')
+            print_error('Cannot specify multiple top-level commands (configure, scan, watch, serve, notifications, export, stats, uninstall)')
             return
         if count == 0:
-            print_error('No top-level command specified (configure (-c), scan (-s), uninstall (-u))')
+            print_error('No top-level command specified (configure (-c), scan (-s), watch (--watch), serve (--serve), notifications (--notifications), export (--export), stats (--stats), uninstall (-u))')
+            return
+        if os.name.lower() != 'nt' and cmd_args.uninstall:
+            print_error(f'os "{os.name}" detected. Uninstalling removes context menu entries, which requires Windows.')
             return
         if cmd_args.configure:
             Configure(cmd_args).configure()
         elif cmd_args.scan:
-            Scanner(cmd_args).scan()
+            Scanner(cmd_args).process()
+        elif cmd_args.watch:
+            Watcher(cmd_args).watch()
+        elif cmd_args.serve:
+            Service(cmd_args).serve()
+        elif cmd_args.notifications:
+            NotificationListener(cmd_args).listen()
+        elif cmd_args.export:
+            Exporter(cmd_args).export()
+        elif cmd_args.stats:
+            print_stats()
         elif cmd_args.uninstall:
             Uninstall(cmd_args).uninstall()
 
+def print_stats():
+    summary = summarize(Common.app_data_file('trace.log'))
+    if len(summary) == 0:
+        print('No trace data found. Set "trace: True" in config.yml and rerun configuration (-c) to start collecting it.')
+        return
+
+    print(f'{"Phase":<20} {"Count":>8} {"p50 (ms)":>10} {"p95 (ms)":>10}')
+    for phase, (count, p50, p95) in sorted(summary.items()):
+        print(f'{phase:<20} {count:>8} {p50:>10.1f} {p95:>10.1f}')
+
 def print_error(msg):
     print(f'ERROR: {msg}')
     print(f'Exiting...')
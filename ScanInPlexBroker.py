@@ -0,0 +1,239 @@
+import json
+import os
+import socket
+import threading
+import time
+
+# A lock file older than this belongs to a broker that died without cleaning up after itself
+STALE_LOCK_SECONDS = 60
+
+class Spool:
+    """
+    Durable queue of scan/refresh requests, stored as one file per request so that
+    requests that haven't been sent to the server yet survive a crash or reboot
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def add(self, request):
+        # Write to a temporary file first so a crash never leaves a partial request behind
+        name = f'{time.time_ns()}-{os.getpid()}.json'
+        temp = os.path.join(self.path, name + '.tmp')
+        with open(temp, 'w') as f:
+            json.dump(request, f)
+        os.replace(temp, os.path.join(self.path, name))
+
+
+    def load(self):
+        """Returns a list of (name, request) for every pending request, oldest first"""
+        entries = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name), 'r') as f:
+                    entries.append((name, json.load(f)))
+            except (OSError, ValueError):
+                self.remove([name])
+        return entries
+
+
+    def remove(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class Broker:
+    """
+    Explorer starts a separate scanner process for every folder in a multi-selection, and
+    impatient users may click the same folder several times. Every process adds its request
+    to the spool, and the first one becomes the broker, listening on a local socket whose
+    port (and a shared secret) it publishes in a lock file. Later processes just let the
+    broker know they added something and exit immediately. Once no new requests have come
+    in for a quiet period, the broker flushes everything in the spool as a single batch.
+    """
+
+    def __init__(self, lock_path, window, max_wait):
+        self.lock_path = lock_path
+        self.window = window
+        self.max_wait = max_wait
+        self.key = None
+        self.listener = None
+        self.acceptor = None
+        self.pending = threading.Event()
+        self.stopping = threading.Event()
+
+
+    def run(self, flush):
+        """
+        Notifies a running broker that there's a new request in the spool, or becomes the
+        broker and calls flush whenever the spool has settled. Returns False if neither was
+        possible, in which case the caller should flush the spool on its own
+        """
+
+        for _ in range(5):
+            if self.notify():
+                return True
+
+            if self.acquire():
+                try:
+                    self.serve(flush)
+                finally:
+                    self.release()
+                return True
+
+            # Someone else holds the lock but isn't listening yet (or just stopped). Try again shortly
+            time.sleep(0.1)
+
+        return False
+
+
+    def notify(self):
+        """Lets the running broker know there's a new request, returning whether the broker acknowledged it"""
+        try:
+            with open(self.lock_path, 'r') as f:
+                lock = json.load(f)
+            with socket.create_connection(('127.0.0.1', lock['port']), timeout=2) as conn:
+                conn.sendall(json.dumps({ 'key' : lock['key'] }).encode('utf-8') + b'\n')
+                return conn.makefile('rb').readline().strip() == b'ok'
+        except Exception:
+            return False
+
+
+    def acquire(self):
+        """Attempts to become the broker by exclusively creating the lock file"""
+        self.remove_stale_lock()
+
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+
+        try:
+            self.key = os.urandom(16).hex()
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.bind(('127.0.0.1', 0))
+            self.listener.listen()
+            self.listener.settimeout(STALE_LOCK_SECONDS / 4)
+            os.write(fd, json.dumps({ 'pid' : os.getpid(), 'port' : self.listener.getsockname()[1], 'key' : self.key }).encode('utf-8'))
+        except Exception:
+            os.close(fd)
+            self.release()
+            return False
+
+        os.close(fd)
+        self.acceptor = threading.Thread(target=self.accept_loop, daemon=True)
+        self.acceptor.start()
+        return True
+
+
+    def remove_stale_lock(self):
+        """
+        Removes the lock file if its broker died without removing it. Other processes may be doing the same at the
+        same time, and one of them may already have replaced it with a fresh lock, so the lock is first moved out of
+        the way under a unique name (which only one process can do) and only deleted if it's still the stale one.
+        Anything else is put back where it was.
+        """
+
+        try:
+            stale = os.stat(self.lock_path)
+        except OSError:
+            return
+        if time.time() - stale.st_mtime <= STALE_LOCK_SECONDS:
+            return
+
+        taken = f'{self.lock_path}.{os.getpid()}.{os.urandom(4).hex()}.stale'
+        try:
+            os.rename(self.lock_path, taken)
+        except OSError:
+            return # Somebody else got to it first
+        try:
+            moved = os.stat(taken)
+            if (moved.st_ino, moved.st_mtime_ns) != (stale.st_ino, stale.st_mtime_ns):
+                os.link(taken, self.lock_path) # Another process's fresh lock. Fails if yet another lock has taken its place
+        except OSError:
+            pass
+        finally:
+            os.remove(taken)
+
+
+    def serve(self, flush):
+        while True:
+            self.wait_for_quiet()
+            flush()
+            if self.pending.is_set():
+                continue
+
+            # Stop listening, then make sure nobody slipped a request in right before we did
+            self.stop_listening()
+            if not self.pending.is_set():
+                return
+
+
+    def wait_for_quiet(self):
+        """Waits until no requests have come in for a full window, or until we've waited long enough"""
+        deadline = time.monotonic() + self.max_wait
+        self.pending.clear()
+        while self.pending.wait(max(0, min(self.window, deadline - time.monotonic()))):
+            self.pending.clear()
+            if time.monotonic() >= deadline:
+                return
+
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.timeout:
+                # Keep the lock fresh so long flushes aren't mistaken for a dead broker
+                try:
+                    os.utime(self.lock_path)
+                except OSError:
+                    pass
+                continue
+            except OSError:
+                return
+
+            if self.stopping.is_set():
+                conn.close()
+                return
+
+            with conn:
+                try:
+                    conn.settimeout(2)
+                    message = json.loads(conn.makefile('rb').readline())
+                    if message.get('key') == self.key:
+                        self.pending.set()
+                        conn.sendall(b'ok\n')
+                except Exception:
+                    pass
+
+
+    def stop_listening(self):
+        if self.acceptor != None:
+            # Wake up the acceptor with a connection of our own so it notices it should stop
+            self.stopping.set()
+            try:
+                socket.create_connection(self.listener.getsockname(), timeout=2).close()
+            except OSError:
+                pass
+            self.acceptor.join()
+            self.acceptor = None
+        if self.listener != None:
+            self.listener.close()
+            self.listener = None
+
+
+    def release(self):
+        # Stop listening before giving up the lock so nobody hands us a request we'll never process
+        self.stop_listening()
+        try:
+            os.remove(self.lock_path)
+        except OSError:
+            pass
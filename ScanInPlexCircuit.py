@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+import time
+
+class CircuitBreaker:
+    """
+    Remembers, across scanner processes, whether the web API has been failing. After enough
+    consecutive failures the circuit "opens" and the web API isn't tried at all for a cool-down
+    period, so every click doesn't have to wait for requests that are going to fail anyway.
+    Once the cool-down is over, a cheap probe decides whether to try the web API again.
+    Each server (host) is tracked separately.
+    """
+
+    def __init__(self, path, threshold, cooldown):
+        self.path = path
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def save(self, state):
+        # Replace the whole file at once so other processes never read a partial state
+        temp = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(state, f)
+            os.replace(temp, self.path)
+        except OSError:
+            pass
+
+
+    def is_open(self, host):
+        """Returns whether the web API of the given server is currently being skipped"""
+        return self.load().get(host, {}).get('open_until', 0) > time.time()
+
+
+    def allow(self, host, probe):
+        """
+        Returns whether the web API should be tried. If the cool-down just ended, probe
+        is called to check whether the server is back before letting requests through
+        """
+
+        host_state = self.load().get(host, {})
+        open_until = host_state.get('open_until', 0)
+        if open_until == 0:
+            return True
+        if open_until > time.time():
+            return False
+
+        if probe():
+            return True
+
+        self.trip(host, host_state.get('failures', self.threshold))
+        return False
+
+
+    def success(self, host):
+        state = self.load()
+        if host in state:
+            del state[host]
+            self.save(state)
+
+
+    def failure(self, host):
+        failures = self.load().get(host, {}).get('failures', 0) + 1
+        if failures >= self.threshold:
+            self.trip(host, failures)
+        else:
+            state = self.load()
+            state[host] = { 'failures' : failures, 'open_until' : 0 }
+            self.save(state)
+
+
+    def trip(self, host, failures):
+        state = self.load()
+        state[host] = { 'failures' : failures, 'open_until' : time.time() + self.cooldown }
+        self.save(state)
@@ -1,12 +1,28 @@
-import ctypes
 import os
 
 def is_admin():
     try:
+        import ctypes # Only needed during configuration, so don't slow down the scanner by importing it up front
         return ctypes.windll.shell32.IsUserAnAdmin()
     except:
         return False
 
+def get_network_drives():
+    """Returns a dict of drive letter (e.g. 'Z:') -> network share for every mapped network drive"""
+    drives = {}
+    try:
+        import ctypes
+        mpr = ctypes.windll.mpr
+    except:
+        return drives
+
+    for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        buffer = ctypes.create_unicode_buffer(1024)
+        size = ctypes.c_ulong(len(buffer))
+        if mpr.WNetGetConnectionW(f'{letter}:', buffer, ctypes.byref(size)) == 0:
+            drives[f'{letter}:'] = buffer.value
+    return drives
+
 def get_yes_no(prompt):
     while True:
         response = input(f'{prompt} (y/n)? ')
@@ -19,3 +35,15 @@ def adjacent_file(filename):
     """Returns the full path to the given file assuming it's in the same directory as the script"""
 
     return os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__))) + os.sep + filename
+
+
+def app_data_file(filename):
+    """
+    Returns the full path to the given file in the folder that holds config.json. That's normally
+    %LOCALAPPDATA%\\ScanInPlex, unless configuration couldn't copy files there and fell back to the
+    script directory (or we're already running from the folder that holds config.json)
+    """
+
+    if os.path.exists(adjacent_file('config.json')) or 'LOCALAPPDATA' not in os.environ:
+        return adjacent_file(filename)
+    return os.path.join(os.environ['LOCALAPPDATA'], 'ScanInPlex', filename)
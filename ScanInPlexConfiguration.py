@@ -1,12 +1,18 @@
 import argparse
+import filecmp
 import json
 import os
 import requests
 import ScanInPlexCommon as Common
+from ScanInPlexIndex import RootIndex, drive_aliases, minimal_roots, parse_sections
+import ScanInPlexRegistry as Registry
 import shutil
 import urllib
 import yaml
 
+# Files the context menu handler needs at runtime, copied alongside config.json
+SCANNER_FILES = ['ScanInPlexScanner.py', 'ScanInPlexCommon.py', 'ScanInPlexBroker.py', 'ScanInPlexIndex.py', 'ScanInPlexItemIndex.py', 'ScanInPlexTrace.py', 'ScanInPlexCircuit.py', 'ScanInPlexGovernor.py', 'ScanInPlexSnapshot.py']
+
 class Configure:
     def __init__(self, cmd_args):
         self.get_config(cmd_args)
@@ -25,18 +31,45 @@ class Configure:
         if not config:
             config = {}
 
-        self.host = self.get_config_value('host', config, cmd_args, 'http://localhost:32400')
-        self.token = self.get_config_value('token', config, cmd_args)
+        self.servers = self.get_servers(config, cmd_args)
+        self.discovery_timeout = float(self.get_config_value('discovery_timeout', config, cmd_args, '10'))
         self.verbose = cmd_args != None and cmd_args.verbose
         self.quiet = cmd_args != None and cmd_args.quiet
         self.refresh = self.get_config_value('add_refresh', config, cmd_args, False)
         self.web = self.refresh or not self.get_config_value('noweb', config, cmd_args, True)
+        self.page_size = int(self.get_config_value('page_size', config, cmd_args, '500'))
+        self.refresh_concurrency = int(self.get_config_value('refresh_concurrency', config, cmd_args, '4'))
+        self.refresh_changed_only = config.get('refresh_changed_only', False) == True
+        self.refresh_strategy = self.get_config_value('refresh_strategy', config, cmd_args, 'per-item')
+        if self.refresh_strategy not in ['auto', 'forced-path', 'per-item']:
+            print(f'WARN: Unknown refresh_strategy "{self.refresh_strategy}". Using per-item')
+            self.refresh_strategy = 'per-item'
+        self.refresh_forced_threshold = int(self.get_config_value('refresh_forced_threshold', config, cmd_args, '20'))
+        self.snapshot_path = config.get('snapshot_path') or None
+        self.broker_window = float(self.get_config_value('broker_window', config, cmd_args, '1.0'))
+        self.broker_max_wait = float(self.get_config_value('broker_max_wait', config, cmd_args, '10.0'))
+        self.busy_wait = float(self.get_config_value('busy_wait', config, cmd_args, '120'))
+        self.scan_fan_out = int(self.get_config_value('scan_fan_out', config, cmd_args, '10'))
+        self.scan_concurrency = int(self.get_config_value('scan_concurrency', config, cmd_args, '4'))
+        self.connect_timeout = float(self.get_config_value('connect_timeout', config, cmd_args, '3'))
+        self.read_timeout = float(self.get_config_value('read_timeout', config, cmd_args, '30'))
+        self.web_retries = int(self.get_config_value('web_retries', config, cmd_args, '2'))
+        self.circuit_threshold = int(self.get_config_value('circuit_threshold', config, cmd_args, '3'))
+        self.circuit_cooldown = float(self.get_config_value('circuit_cooldown', config, cmd_args, '300'))
+        self.max_in_flight = int(self.get_config_value('max_in_flight', config, cmd_args, '4'))
+        self.max_request_rate = float(self.get_config_value('max_request_rate', config, cmd_args, '100'))
+        self.slow_latency = float(self.get_config_value('slow_latency', config, cmd_args, '2'))
+        self.sections_ttl = float(self.get_config_value('sections_ttl', config, cmd_args, '86400'))
+        self.sections_retry = float(self.get_config_value('sections_retry', config, cmd_args, '60'))
+        self.trace = config.get('trace', False) == True
+        self.trace_max_kb = int(self.get_config_value('trace_max_kb', config, cmd_args, '1024'))
         if self.verbose and self.quiet:
             print('WARN: Both --verbose and --quiet specified. Keeping --verbose')
             self.quiet = False
         self.pms_path = None
         self.pyw_path = None
         self.output_path = None
+        self.drives = Common.get_network_drives()
 
         self.is_admin = Common.is_admin()
 
@@ -48,7 +81,7 @@ class Configure:
             if self.is_admin:
                 os.system('pause')
 
-        if not self.is_admin and not self.quiet:
+        if not self.is_admin and not self.quiet and os.name == 'nt':
             print('\nNOTE: Script is not running with admin privileges. This script modifies the')
             print('      registry, which requires elevation. You may see a UAC prompt, as well')
             print('      as a warning about modifying the registry. This is expected.\n')
@@ -67,7 +100,7 @@ class Configure:
         if self.verbose:
             print('\nFound library mappings:\n')
             for section in sections:
-                print(f'  Section {section["section"]}:')
+                print(f'  Section {section["section"]} ({self.servers[section["server"]]["host"]}):')
                 for section_path in section['paths']:
                     print(f'    {section_path}')
                 print()
@@ -76,163 +109,188 @@ class Configure:
                 print('Exiting...')
                 return
 
+        if os.name != 'nt':
+            # There's no context menu (or Plex Media Scanner.exe) outside of Windows, but --serve only needs config.json
+            self.create_mapping_json(sections)
+            if not self.quiet:
+                print('\nConfiguration saved. Run ScanInPlex.py --serve to start accepting scan requests.')
+            return
+
         if self.create_registry_entries(sections):
             self.create_mapping_json(sections)
             if not self.quiet:
-                print('\nContext menu entries have been added!')
+                print('\nContext menu entries are up to date!')
+
+
+    def get_servers(self, config, cmd_args=None):
+        """
+        Returns the list of servers ({ 'host', 'token' }) to configure, and sets host/token to the first
+        one. That's the servers list in config.yml if there is one, and otherwise the single host/token
+        given in config.yml or on the command line (asking for the token if neither has it), which is
+        only read when there's no list. The first server is assumed to be the one running on this machine.
+        """
+
+        servers = config.get('servers')
+        if not servers:
+            self.host = self.get_config_value('host', config, cmd_args, 'http://localhost:32400')
+            self.token = self.get_config_value('token', config, cmd_args)
+            return [{ 'host' : self.host, 'token' : self.token }]
+
+        servers = [{ 'host' : server.get('host') or 'http://localhost:32400', 'token' : server.get('token') or '' } for server in servers]
+        self.host = servers[0]['host']
+        self.token = servers[0]['token']
+        return servers
 
 
     def get_library_mappings(self):
+        """
+        Returns the library sections of every server, each tagged with the position of the server that
+        owns it. Servers are asked at the same time, and a server that fails or doesn't respond within
+        discovery_timeout seconds is skipped (with a warning) instead of holding up the rest.
+        """
+
         if not self.quiet:
             print('Looking for library sections...', end='', flush=True)
-        sections = self.get_json_response('/library/sections', { 'X-Plex-Features' : 'external-media,indirect-media' })
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(len(self.servers)) as pool:
+            results = list(pool.map(self.get_server_sections, self.servers))
         if not self.quiet:
             print('Done')
-        if sections == None:
-            print('Sorry, something went wrong processing library sections. Make sure your host and token are properly set')
-            return None
 
         mappings = []
+        for i in range(len(self.servers)):
+            if results[i] == None:
+                print(f'WARN: Could not get library sections from {self.servers[i]["host"]}. Make sure its host and token are properly set')
+                continue
+            mappings.extend(dict(section, server=i) for section in results[i])
 
-        if 'Directory' not in sections:
-            print('Malformed response from host, exiting...')
+        if all(result == None for result in results):
+            print('Sorry, something went wrong processing library sections. Make sure your host and token are properly set')
             return None
 
-        for section in sections['Directory']:
-            mappings.append({ 'section' : section['key'], 'type' : section['type'], 'paths' : [entry['path'] for entry in section['Location']] })
         return mappings
 
 
-    def create_registry_entries(self, sections):
-        """
-        Adds the right registry entries to enable the context menu entries
-        """
-
-        base_key = 'HKEY_CLASSES_ROOT\\Directory\\shell\\ScanInPlex'
-        icon_path = self.get_pms_path()
-        applies_to = self.get_appliesTo_path(sections)
-        pythonw_path = self.get_pythonw_path()
-        scanner = os.path.join(self.get_output_path(), 'ScanInPlexScanner.py')
+    def get_server_sections(self, server):
+        """Returns the library sections of a single server, or None if they couldn't be retrieved"""
+        try:
+            sections = self.get_json_response('/library/sections', { 'X-Plex-Features' : 'external-media,indirect-media' }, server, self.discovery_timeout)
+        except Exception:
+            return None
+        return parse_sections(sections)
 
-        if self.is_admin:
-            return self.create_registry_entries_as_admin(base_key, icon_path, applies_to, pythonw_path, scanner)
-        else:
-            return self.create_registry_entries_from_file(base_key, icon_path, applies_to, pythonw_path, scanner)
 
-    def create_registry_entries_as_admin(self, base_key, icon_path, applies_to, pythonw_path, scanner):
+    def create_registry_entries(self, sections):
         """
-        Uses REG ADD to add the right registry keys. Avoids the UAC and registry prompts,
-        but can only be run as an administrator
+        Adds the right registry entries to enable the context menu entries. Only values that differ
+        from what's already installed are written, all at once, so reconfiguring without any library
+        changes doesn't touch the registry at all. Returns whether configuration should continue.
         """
-        commands = [
-            f'REG ADD {base_key} /ve /t REG_SZ /d "Scan In Ple&x"',
-            f'REG ADD {base_key} /v "Icon" /t REG_SZ /d "\\"{icon_path}\\",0"',
-            f'REG ADD {base_key} /v "AppliesTo" /t  REG_SZ /d "{applies_to}"',
-            f'REG ADD {base_key} /v "MultiSelectModel" /t REG_SZ /d "Document"',
-            f'REG ADD {base_key}\\command /ve /t REG_SZ /d "\\"{pythonw_path}\\" \\"{scanner}\\" -d \\"%1\\""'
-        ]
-
-        if self.refresh:
-            refresh_base = base_key.replace('ScanInPlex', 'RefreshInPlex')
-            commands.extend([
-                f'REG ADD {refresh_base} /ve /t REG_SZ /d "Refresh Plex Metadata"',
-                f'REG ADD {refresh_base} /v "Icon" /t REG_SZ /d "\\"{icon_path}\\",0"',
-                f'REG ADD {refresh_base} /v "AppliesTo" /t  REG_SZ /d "{applies_to}"',
-                f'REG ADD {refresh_base} /v "MultiSelectModel" /t REG_SZ /d "Document"',
-                f'REG ADD {refresh_base}\\command /ve /t REG_SZ /d "\\"{pythonw_path}\\" \\"{scanner}\\" -r -d \\"%1\\""'
-            ])
+
+        registry = Registry.get_backend(self.is_admin)
+        changes = Registry.diff(self.get_registry_state(sections), registry)
+        if len(changes) == 0:
+            if not self.quiet:
+                print('Context menu entries are already up to date')
+            return True
 
         if self.verbose:
             print('\n\nRegistry modifications:\n')
-            for cmd in commands:
-                print(cmd)
+            for line in Registry.describe(changes):
+                print(line)
             print()
             if not Common.get_yes_no('Do you want to make the above registry changes'):
-                print ('Exiting...')
+                print('Exiting...')
                 return False
 
         if not self.quiet:
-            print('Adding registry entries...', end='', flush=True)
-        for cmd in commands:
-            os.system(f'{cmd} /f >NUL')
+            print('Adding registry entries' + ('...' if self.is_admin else '. This may launch a UAC dialog...'), end='', flush=True)
+        try:
+            registry.apply(changes)
+        except OSError as e:
+            print(f'\nError adding registry entries: {e}')
+            return False
         if not self.quiet:
-            print('Done!')
+            print(' Done!')
         return True
 
 
-    def create_registry_entries_from_file(self, base_key, icon_path, applies_to, pythonw_path, scanner):
+    def get_registry_state(self, sections):
         """
-        Adds registry entries by creating a .reg file and executing it. Used as
-        a backup for when the script is not run with administrator privileges
+        Returns the registry keys and values (relative to HKEY_CLASSES_ROOT) the context menu entries
+        should have. The refresh entry maps to None if it isn't wanted, so an old one gets removed
         """
 
-        # .reg files need extra escapes
-        icon_path = icon_path.replace('\\', '\\\\')
-        pythonw_path = pythonw_path.replace('\\', '\\\\')
-        scanner = scanner.replace('\\', '\\\\')
-
-        text  = f'Windows Registry Editor Version 5.00\n\n'
-
-        text += f'[{base_key}]\n'
-        text += f'@="Scan in Plex"\n'
-        text += f'"Icon"="\\"{icon_path}\\",0"\n'
-        text += f'"AppliesTo"="{applies_to}"\n'
-        text += f'"MultiSelectModel"="Document"\n\n'
-
-        text += f'[{base_key}\\command]\n'
-        text += f'@="\\"{pythonw_path}\\" \\"{scanner}\\" -d \\"%1\\""\n'
-
-        if self.refresh:
-            refresh_base = base_key.replace('ScanInPlex', 'RefreshInPlex')
-            text += f'\n[{refresh_base}]\n'
-            text += f'@="Refresh Plex Metadata"\n'
-            text += f'"Icon"="\\"{icon_path}\\",0"\n'
-            text += f'"AppliesTo"="{applies_to}"\n'
-            text += f'"MultiSelectModel"="Document"\n\n'
-
-            text += f'[{refresh_base}\\command]\n'
-            text += f'@="\\"{pythonw_path}\\" \\"{scanner}\\" -r -d \\"%1\\""\n'
-
-        if self.verbose:
-            print('\n\nRegistry modifications:\n')
-            print(f'{text}')
-            if not Common.get_yes_no('Do you want to make the above registry changes'):
-                print('Exiting...')
-                return False
+        icon = f'"{self.get_pms_path()}",0'
+        applies_to = self.get_appliesTo_path(sections)
+        scanner = os.path.join(self.get_output_path(), 'ScanInPlexScanner.py')
+        command = f'"{self.get_pythonw_path()}" "{scanner}"'
 
-        if not self.quiet:
-            print('Adding registry entries. This may launch a UAC dialog...', end='', flush=True)
-        reg_temp = '_scanInPlex.tmp.reg'
-        try:
-            with open(reg_temp, 'w') as reg:
-                reg.writelines([text])
-        except Exception as e:
-            print('\nError adding registry entries:')
-            raise e
-
-        os.system(f'.\\{reg_temp}')
-        os.remove(reg_temp)
-        if not self.quiet:
-            print(' Done!')
-        return True
+        state = {}
+        scan_key, refresh_key = Registry.MENU_KEYS
+        for key, label, flags, wanted in [(scan_key, 'Scan In Ple&x', '', True), (refresh_key, 'Refresh Plex Metadata', ' -r', self.refresh)]:
+            state[key] = { '' : label, 'Icon' : icon, 'AppliesTo' : applies_to, 'MultiSelectModel' : 'Document' } if wanted else None
+            state[f'{key}\\command'] = { '' : f'{command}{flags} -d "%1"' } if wanted else None
+        return state
 
 
     def create_mapping_json(self, sections):
+        """Writes config.json, unless it already has the exact same contents. Returns whether it was written"""
         config = {
-            'exe' : self.get_scanner_path(),
+            'exe' : self.get_scanner_path() if os.name == 'nt' else None,
             'sections' : sections,
+            'index' : RootIndex.build(sections, self.drives).to_json(),
+            'drives' : self.drives,
+            'broker_window' : self.broker_window,
+            'broker_max_wait' : self.broker_max_wait,
+            'scan_fan_out' : self.scan_fan_out,
+            'scan_concurrency' : self.scan_concurrency,
+            'trace' : self.trace,
+            'trace_max_kb' : self.trace_max_kb,
         }
 
         if self.web:
             config['host'] = self.host
             config['token'] = self.token
+            config['servers'] = self.servers
+            config['page_size'] = self.page_size
+            config['refresh_concurrency'] = self.refresh_concurrency
+            config['refresh_changed_only'] = self.refresh_changed_only
+            config['refresh_strategy'] = self.refresh_strategy
+            config['refresh_forced_threshold'] = self.refresh_forced_threshold
+            config['snapshot_path'] = self.snapshot_path
+            config['busy_wait'] = self.busy_wait
+            config['connect_timeout'] = self.connect_timeout
+            config['read_timeout'] = self.read_timeout
+            config['web_retries'] = self.web_retries
+            config['circuit_threshold'] = self.circuit_threshold
+            config['circuit_cooldown'] = self.circuit_cooldown
+            config['max_in_flight'] = self.max_in_flight
+            config['max_request_rate'] = self.max_request_rate
+            config['slow_latency'] = self.slow_latency
+            config['sections_ttl'] = self.sections_ttl
+            config['sections_retry'] = self.sections_retry
+
+        # We just fetched the sections, so the scanner doesn't need to check them again for a while
+        with open(os.path.join(self.get_output_path(), 'sections.checked'), 'a'):
+            pass
+        os.utime(os.path.join(self.get_output_path(), 'sections.checked'))
+
+        config_file = os.path.join(self.get_output_path(), 'config.json')
+        try:
+            with open(config_file, 'r') as f:
+                if json.load(f) == config:
+                    return False
+        except (OSError, ValueError):
+            pass
 
         if not self.quiet:
             print('Writing config file...', end='', flush=True)
-        with open(os.path.join(self.get_output_path(), 'config.json'), 'w') as f:
+        with open(config_file, 'w') as f:
             json.dump(config, f)
         if not self.quiet:
             print('Done!')
+        return True
 
 
     def get_pms_path(self):
@@ -262,27 +320,34 @@ class Configure:
         """
 
         applies_to = ''
-        for section in sections:
-            for path in section['paths']:
-                # extra backslashes are needed if we're creating a .reg file
-                final_path = path
-                if not self.is_admin:
-                    final_path = final_path.replace('\\', '\\\\')
-
-                # Need two entries per path. One to exactly match the root folder, and
-                # another to match subpaths. With only a single entry, there are two possibilities
-                #  1. Display:~="C:\Root", which may incorrect match C:\Root2
-                #  2. Display:~="C:\Root\", which blocks C:\Root2, but also only allows scanning of
-                #     subdirectories of C:\Root, and not C:\Root itself
-                # To get around this have two entries:
-                #  1. Display:="C:\Root" for the exact match of the root folder
-                #  2. Display:~="C:\Root\" for all subfolders
-                applies_to += ' OR System.ItemPathDisplay:=\\"' + final_path + '\\"'
-                final_path += '\\\\'
-                applies_to += ' OR System.ItemPathDisplay:~=\\"' + final_path + '\\"'
+        for path in self.get_appliesTo_roots(sections):
+            # Need two entries per path. One to exactly match the root folder, and
+            # another to match subpaths. With only a single entry, there are two possibilities
+            #  1. Display:~="C:\Root", which may incorrect match C:\Root2
+            #  2. Display:~="C:\Root\", which blocks C:\Root2, but also only allows scanning of
+            #     subdirectories of C:\Root, and not C:\Root itself
+            # To get around this have two entries:
+            #  1. Display:="C:\Root" for the exact match of the root folder
+            #  2. Display:~="C:\Root\" for all subfolders
+            applies_to += ' OR System.ItemPathDisplay:="' + path + '"'
+            applies_to += ' OR System.ItemPathDisplay:~="' + path + '\\"'
         return applies_to[4:]
 
 
+    def get_appliesTo_roots(self, sections):
+        """
+        Returns the smallest set of folders that covers every section root. Explorer evaluates the
+        whole AppliesTo expression on every right-click, so duplicate roots, roots nested inside
+        other roots, and differently spelled copies of the same root are dropped. Roots on mapped
+        network drives are also added under their other spelling (drive letter or share) so the
+        menu shows up no matter how the folder was reached.
+        """
+
+        roots = minimal_roots(path for section in sections for path in section['paths'])
+        aliases = [alias for root in roots for alias in drive_aliases(root, self.drives)]
+        return minimal_roots(roots + aliases)
+
+
     def get_pythonw_path(self):
         """
         Returns the path to pythonw, which we'll use to silently launch our script
@@ -317,8 +382,10 @@ class Configure:
                     print('Unable to make directory')
                     pass
             try:
-                shutil.copy(Common.adjacent_file('ScanInPlexScanner.py'), os.path.join(dst, 'ScanInPlexScanner.py'))
-                shutil.copy(Common.adjacent_file('ScanInPlexCommon.py'), os.path.join(dst, 'ScanInPlexCommon.py'))
+                for scanner_file in SCANNER_FILES:
+                    src = Common.adjacent_file(scanner_file)
+                    if not os.path.exists(os.path.join(dst, scanner_file)) or not filecmp.cmp(src, os.path.join(dst, scanner_file), shallow=False):
+                        shutil.copy(src, os.path.join(dst, scanner_file))
                 self.output_path = dst
             except:
                 pass
@@ -363,8 +430,8 @@ class Configure:
         return input(f'\nCould not find "{key}" and no default is available.\n\nPlease enter a value for "{key}": ')
 
 
-    def get_json_response(self, url, params={}):
-        response = requests.get(self.url(url, params), headers={ 'Accept' : 'application/json' })
+    def get_json_response(self, url, params={}, server=None, timeout=None):
+        response = requests.get(self.url(url, params, server), headers={ 'Accept' : 'application/json' }, timeout=timeout)
         try:
             data = json.loads(response.content)['MediaContainer']
         except:
@@ -376,11 +443,12 @@ class Configure:
         return data
 
 
-    def url(self, base, params={}):
-        real_url = f'{self.host}{base}'
+    def url(self, base, params={}, server=None):
+        server = server or { 'host' : self.host, 'token' : self.token }
+        real_url = f'{server["host"]}{base}'
         sep = '?'
         for key, value in params.items():
             real_url += f'{sep}{key}={urllib.parse.quote(value)}'
             sep = '&'
 
-        return f'{real_url}{sep}X-Plex-Token={self.token}'
+        return f'{real_url}{sep}X-Plex-Token={server["token"]}'
@@ -0,0 +1,183 @@
+import json
+import os
+import random
+import re
+import time
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+# The request rate never drops below this many requests per second, however slow the server gets
+MIN_RATE = 1.0
+
+# Weight given to the latest response time in the running average
+LATENCY_WEIGHT = 0.2
+
+def lock_file(f, blocking=True):
+    """
+    Takes an exclusive OS lock on the given open file, returning False if blocking is False
+    and someone else holds it. The OS releases the lock if the process dies, so a crashed
+    scanner can never leave a lock behind. Every open file is locked separately, even within
+    a single process, so threads have to open their own.
+    """
+
+    if msvcrt == None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            return True
+        except OSError:
+            return False
+
+    # msvcrt's blocking lock gives up after 10 seconds, so keep polling instead
+    while True:
+        try:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(random.uniform(0.005, 0.02))
+
+
+def unlock_file(f):
+    if msvcrt != None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class Governor:
+    """
+    Limits the requests all scanner processes send to a server, since every context menu click
+    is its own process and nothing else stops a multi-selection (or a shared workstation) from
+    flooding Plex. Each server gets max_in_flight slot files, and a request only goes out while
+    holding the lock on one of them, so no more than max_in_flight requests are ever in flight
+    at once. Requests also take a token from a bucket shared through a state file, which refills
+    at a rate that adapts to how quickly the server responds: it's halved whenever a response
+    takes longer than slow_latency (or fails), and otherwise creeps back up towards max_rate.
+    """
+
+    def __init__(self, path, max_in_flight, max_rate, slow_latency):
+        self.path = path
+        self.max_in_flight = max_in_flight
+        self.max_rate = max_rate
+        self.slow_latency = slow_latency
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def request(self, host):
+        """Returns a context manager to send a single request to the given server (host:port) in"""
+        return GovernedRequest(self, re.sub(r'[^A-Za-z0-9.-]', '_', host))
+
+
+    def acquire_slot(self, name):
+        """Waits for a free slot, returning the open (and locked) slot file"""
+        first = random.randrange(self.max_in_flight) # Don't have everyone fight over the first slot
+        delay = 0.01
+        while True:
+            for i in range(self.max_in_flight):
+                f = open(os.path.join(self.path, f'{name}.{(first + i) % self.max_in_flight}.slot'), 'a+')
+                if lock_file(f, False):
+                    return f
+                f.close()
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, 0.25)
+
+
+    def update(self, name, change):
+        """Calls change with the server's shared state (a dict it can modify) while holding its lock, returning the result"""
+        with open(os.path.join(self.path, f'{name}.lock'), 'a+') as lock:
+            lock_file(lock)
+            try:
+                state_path = os.path.join(self.path, f'{name}.json')
+                try:
+                    with open(state_path, 'r') as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = { 'rate' : self.max_rate, 'tokens' : self.max_in_flight, 'time' : time.time(), 'latency' : 0 }
+
+                result = change(state)
+                with open(state_path, 'w') as f:
+                    json.dump(state, f)
+                return result
+            finally:
+                unlock_file(lock)
+
+
+    def take_token(self, name):
+        """Takes a token from the server's bucket, returning how long to wait before it can be used"""
+        def take(state):
+            now = time.time()
+            rate = min(state['rate'], self.max_rate) # max_rate may have been lowered since
+            state['tokens'] = min(self.max_in_flight, state['tokens'] + (now - state['time']) * rate) - 1
+            state['time'] = now
+            return max(0, -state['tokens'] / rate)
+        return self.update(name, take)
+
+
+    def record(self, name, latency, ok):
+        """Adapts the server's rate to how long a request took, and whether it succeeded"""
+        def adapt(state):
+            state['latency'] = latency if state['latency'] == 0 else (1 - LATENCY_WEIGHT) * state['latency'] + LATENCY_WEIGHT * latency
+            now = time.time()
+            if not ok or latency > self.slow_latency:
+                # Halve at most once per slow response time, otherwise every request that was
+                # already in flight when the server slowed down would halve it again
+                if now - state.get('slowed', 0) > latency:
+                    state['rate'] = max(MIN_RATE, state['rate'] / 2)
+                    state['slowed'] = now
+            else:
+                # For every second's worth of fast responses, allow one more request per second
+                state['rate'] = min(self.max_rate, state['rate'] + 1 / state['rate'])
+        self.update(name, adapt)
+
+
+    def state(self, host):
+        """Returns the current shared state of the given server, for reporting"""
+        return self.update(re.sub(r'[^A-Za-z0-9.-]', '_', host), dict)
+
+
+class GovernedRequest:
+    """
+    Context manager that holds a slot for the duration of a single request. Set ok to False
+    if the server returned an error, so the rate backs off as though the server were slow.
+    """
+
+    def __init__(self, governor, name):
+        self.governor = governor
+        self.name = name
+        self.slot = None
+        self.start = None
+        self.ok = True
+
+
+    def __enter__(self):
+        self.slot = self.governor.acquire_slot(self.name)
+        try:
+            wait = self.governor.take_token(self.name)
+        except:
+            self.release()
+            raise
+        if wait > 0:
+            time.sleep(wait)
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        latency = time.perf_counter() - self.start
+        self.release()
+        self.governor.record(self.name, latency, self.ok and exc_type == None)
+        return False
+
+
+    def release(self):
+        try:
+            unlock_file(self.slot)
+        finally:
+            self.slot.close()
@@ -0,0 +1,143 @@
+import ntpath
+
+def normalize_path(path, drives=None):
+    """
+    Returns the canonical spelling of a path: backslash separators, no trailing separator, and no
+    . or .. segments. If drives (drive letter -> network share) is given, a mapped network drive
+    is replaced by the share it points to, so both spellings of the same folder line up.
+    """
+
+    path = ntpath.normpath(path)
+    if drives and path[1:2] == ':':
+        share = drives.get(path[:2].upper())
+        if share != None:
+            path = ntpath.normpath(share + path[2:])
+    return path.rstrip('\\') or path
+
+
+def parse_sections(container):
+    """
+    Returns the sections in a /library/sections MediaContainer in the form stored in config.json,
+    i.e. a list of { 'section', 'type', 'paths' }, or None if the container isn't what we expect
+    """
+
+    if container == None or 'Directory' not in container:
+        return None
+    try:
+        return [{ 'section' : section['key'], 'type' : section['type'], 'paths' : [entry['path'] for entry in section['Location']] } for section in container['Directory']]
+    except (KeyError, TypeError):
+        return None
+
+
+def path_key(path, drives=None):
+    """Returns the casefolded canonical form of a path used for comparisons"""
+    return normalize_path(path, drives).casefold()
+
+
+def drive_aliases(path, drives):
+    """Returns the other spellings of the given path through mapped network drives (drive letter <-> share)"""
+    if not drives:
+        return []
+
+    path = normalize_path(path)
+    key = path.casefold()
+    aliases = []
+    for drive, share in drives.items():
+        share_key = path_key(share)
+        if key[:2] == drive.casefold() and (len(key) == 2 or key[2] == '\\'):
+            aliases.append(normalize_path(share + path[2:]))
+        elif key.startswith(share_key) and (len(key) == len(share_key) or key[len(share_key)] == '\\'):
+            aliases.append(drive.upper() + path[len(share_key):])
+    return aliases
+
+
+def minimal_roots(paths, drives=None):
+    """
+    Returns the given roots in canonical form, minus duplicates (including ones that only differ
+    in case, separators, or spelling) and minus roots nested inside another root, since the
+    outer root already covers them. Order is preserved otherwise.
+    """
+
+    paths = list(paths)
+    outer = RootIndex(drives=drives)
+    for i in sorted(range(len(paths)), key=lambda i: len(RootIndex.split(paths[i], drives))):
+        if outer.lookup(paths[i]) == None:
+            outer.add(paths[i], i)
+
+    kept = set(outer.values())
+    return [normalize_path(paths[i]) for i in range(len(paths)) if i in kept]
+
+
+class RootIndex:
+    """
+    Maps library root folders to the section that owns them. Roots are stored in a trie
+    keyed on casefolded path components, so a lookup costs as much as the depth of the
+    path being looked up, regardless of how many roots there are.
+
+    Each node is a dict with an optional 'c' (children, keyed by component) and an
+    optional 's' (the position of the owning section in config.json's section list),
+    which keeps the whole thing directly serializable to/from JSON.
+    """
+
+    def __init__(self, trie=None, drives=None):
+        self.trie = trie if trie != None else {}
+        self.drives = drives
+
+
+    @staticmethod
+    def split(path, drives=None):
+        """Splits a path into its casefolded canonical components (see normalize_path)"""
+        return path_key(path, drives).split('\\')
+
+
+    @classmethod
+    def build(cls, sections, drives=None):
+        """Builds an index for the given list of sections, as stored in config.json"""
+        index = cls(drives=drives)
+        for i in range(len(sections)):
+            for path in sections[i]['paths']:
+                index.add(path, i)
+        return index
+
+
+    def add(self, path, value):
+        node = self.trie
+        for component in RootIndex.split(path, self.drives):
+            node = node.setdefault('c', {}).setdefault(component, {})
+
+        # If the same root is listed more than once, the first section that claims it wins
+        node.setdefault('s', value)
+
+
+    def lookup(self, path):
+        """
+        Returns the value associated with the longest root that contains the given path,
+        or None if the path isn't under any root. Partial component matches are ignored,
+        i.e. Z:\\Movies2\\SomeFolder will not match Z:\\Movies
+        """
+
+        node = self.trie
+        match = None
+        for component in RootIndex.split(path, self.drives):
+            children = node.get('c')
+            if children == None or component not in children:
+                break
+            node = children[component]
+            match = node.get('s', match)
+        return match
+
+
+    def values(self):
+        """Returns every value in the index"""
+        values = []
+        remaining = [self.trie]
+        while len(remaining) > 0:
+            node = remaining.pop()
+            if 's' in node:
+                values.append(node['s'])
+            remaining.extend(node.get('c', {}).values())
+        return values
+
+
+    def to_json(self):
+        return self.trie
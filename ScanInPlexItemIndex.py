@@ -0,0 +1,113 @@
+import sqlite3
+from ScanInPlexIndex import path_key
+
+# Bump whenever the schema changes. The index is only a cache of what's on the server,
+# so an outdated index is simply thrown away and rebuilt.
+SCHEMA_VERSION = 3
+
+class ItemIndex:
+    """
+    Persistent map of the file paths in each library section to the items that own them,
+    letting a metadata refresh find everything under a folder with an indexed range query
+    instead of downloading and searching the whole section. The size of each file and the
+    time its item was last updated are kept too, to tell which files changed since, along
+    with the item's parent and grandparent (e.g. season and show) to refresh those instead.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.ensure_schema()
+
+
+    def close(self):
+        self.db.close()
+
+
+    def ensure_schema(self):
+        if self.db.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+            return
+
+        self.db.executescript(f'''
+            DROP TABLE IF EXISTS items;
+            DROP TABLE IF EXISTS sections;
+            CREATE TABLE items (
+                section TEXT NOT NULL,
+                path TEXT NOT NULL,
+                rating_key INTEGER NOT NULL,
+                parent_rating_key INTEGER,
+                grandparent_rating_key INTEGER,
+                file TEXT NOT NULL,
+                size INTEGER,
+                updated_at INTEGER,
+                PRIMARY KEY (section, path)) WITHOUT ROWID;
+            CREATE INDEX items_by_key ON items (section, rating_key);
+            CREATE TABLE sections (
+                section TEXT PRIMARY KEY,
+                item_count INTEGER NOT NULL,
+                checkpoint INTEGER NOT NULL);
+            PRAGMA user_version = {SCHEMA_VERSION};''')
+
+
+    def get_sync_state(self, section):
+        """Returns the (item count, checkpoint) of the last sync for the given section, or None if it was never synced"""
+        return self.db.execute('SELECT item_count, checkpoint FROM sections WHERE section=?', (section,)).fetchone()
+
+
+    def item_count(self, section):
+        return self.db.execute('SELECT COUNT(DISTINCT rating_key) FROM items WHERE section=?', (section,)).fetchone()[0]
+
+
+    def rebuild(self, section, items, checkpoint=0):
+        """Replaces everything known about the given section with the given items"""
+        with self.db:
+            self.db.execute('DELETE FROM items WHERE section=?', (section,))
+            self.db.execute('DELETE FROM sections WHERE section=?', (section,))
+        self.update(section, items, checkpoint)
+
+
+    def update(self, section, items, checkpoint):
+        """
+        Adds or replaces the given items, recording the newest updatedAt seen (or the
+        given checkpoint if it's newer) as the point to sync from next time
+        """
+
+        with self.db:
+            for item in items:
+                rating_key = int(item['ratingKey'])
+                parent_key = int(item['parentRatingKey']) if 'parentRatingKey' in item else None
+                grandparent_key = int(item['grandparentRatingKey']) if 'grandparentRatingKey' in item else None
+                updated_at = int(item['updatedAt']) if 'updatedAt' in item else None
+                checkpoint = max(checkpoint, updated_at or 0)
+                self.db.execute('DELETE FROM items WHERE section=? AND rating_key=?', (section, rating_key))
+                for version in item.get('Media', []):
+                    for part in version.get('Part', []):
+                        if 'file' in part:
+                            self.db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (section, path_key(part['file']), rating_key, parent_key, grandparent_key, part['file'], part.get('size'), updated_at))
+
+            self.db.execute('INSERT OR REPLACE INTO sections VALUES (?, ?, ?)', (section, self.item_count(section), checkpoint))
+
+
+    def remove(self, section, rating_key):
+        """Removes an item, or every item whose parent or grandparent it is (e.g. the tracks of an album, or the episodes of a show)"""
+        with self.db:
+            self.db.execute('DELETE FROM items WHERE section=? AND (rating_key=? OR parent_rating_key=? OR grandparent_rating_key=?)',
+                (section, rating_key, rating_key, rating_key))
+            self.db.execute('UPDATE sections SET item_count=? WHERE section=?', (self.item_count(section), section))
+
+
+    def rows(self, section):
+        """Returns the (ratingKey, parentRatingKey, grandparentRatingKey, updatedAt, file, size) of every file in the section, sorted by ratingKey"""
+        return self.db.execute(
+            'SELECT rating_key, parent_rating_key, grandparent_rating_key, updated_at, file, size FROM items WHERE section=? ORDER BY rating_key',
+            (section,))
+
+
+    def find(self, section, directory):
+        """Returns the (ratingKey, parentRatingKey, grandparentRatingKey, file, size, updatedAt) of every file under the given directory"""
+        prefix = path_key(directory)
+
+        # All paths under the directory sort between "prefix\" and "prefix]", since ']' directly follows '\'
+        return self.db.execute(
+            'SELECT rating_key, parent_rating_key, grandparent_rating_key, file, size, updated_at FROM items WHERE section=? AND path >= ? AND path < ?',
+            (section, prefix + '\\', prefix + ']')).fetchall()
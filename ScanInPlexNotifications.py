@@ -0,0 +1,295 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+import ScanInPlexCommon as Common
+from ScanInPlexScanner import ConfigFile, Scanner
+
+# Seconds of silence before checking that the connection is still alive with a ping. If the
+# ping isn't answered within the same time, the connection is considered dead
+PING_INTERVAL = 30
+
+# Reconnection delays start at MIN_BACKOFF seconds and double up to MAX_BACKOFF
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+# Timeline entry states, as sent by Plex
+STATE_DONE = 5
+STATE_DELETED = 9
+
+# A connection that stays up this long counts as healthy, resetting the reconnection delay
+HEALTHY_SECONDS = 60
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+class WebSocket:
+    """
+    A minimal RFC 6455 websocket client, just enough to read the notifications Plex sends.
+    Only the frames Plex actually uses (text, ping, pong, and close) are handled.
+    """
+
+    def __init__(self, url, timeout):
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme in ['https', 'wss']
+        self.sock = socket.create_connection((parts.hostname, parts.port or (443 if secure else 80)), timeout)
+        if secure:
+            import ssl
+            self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=parts.hostname)
+        self.buffer = bytearray()
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f'GET {parts.path}?{parts.query} HTTP/1.1\r\n'
+            f'Host: {parts.netloc}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n').encode('ascii'))
+
+        while b'\r\n\r\n' not in self.buffer:
+            self.fill()
+        end = self.buffer.index(b'\r\n\r\n')
+        lines = self.buffer[:end].decode('latin-1').split('\r\n')
+        del self.buffer[:end + 4]
+
+        status = lines[0].split(' ')
+        headers = { name.strip().lower() : value.strip() for name, _, value in [line.partition(':') for line in lines[1:]] }
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode()
+        if len(status) < 2 or status[1] != '101' or headers.get('sec-websocket-accept') != accept:
+            self.close()
+            raise ConnectionError(f'Websocket upgrade refused ({lines[0]})')
+
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if len(data) == 0:
+            raise ConnectionError('Connection closed')
+        self.buffer.extend(data)
+
+
+    def read(self, count):
+        while len(self.buffer) < count:
+            self.fill()
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+
+    def recv(self):
+        """Returns the next text message, or None once the server closes the connection"""
+        message = b''
+        pinged = False
+        while True:
+            try:
+                first, second = self.read(2)
+            except socket.timeout:
+                # Reading picks up where it left off, since nothing is taken from the buffer until it's all there
+                if pinged:
+                    raise ConnectionError('Server stopped responding')
+                self.send(0x9, b'')
+                pinged = True
+                continue
+            pinged = False
+
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.read(8))[0]
+            mask = self.read(4) if second & 0x80 else None
+            payload = self.read(length)
+            if mask != None:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+            if opcode == 0x8: # Close
+                self.send(0x8, payload[:2])
+                return None
+            if opcode == 0x9: # Ping
+                self.send(0xA, payload)
+            elif opcode in [0x0, 0x1, 0x2]: # Continuation, text, binary
+                message += payload
+                if first & 0x80: # Final fragment
+                    return message.decode('utf-8')
+
+
+    def send(self, opcode, payload):
+        # Everything a client sends has to be masked
+        mask = os.urandom(4)
+        header = struct.pack('!BB', 0x80 | opcode, 0x80 | len(payload)) # Control frames are always short
+        self.sock.sendall(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+
+    def close(self):
+        # Shut down first, so that a recv blocked in another thread returns
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class NotificationListener:
+    """
+    Keeps config.json and the item index up to date by listening to the notifications each
+    server publishes, instead of polling. Items that are added, updated, or deleted are applied
+    to the item index as soon as Plex has processed them, so refreshes don't have to find out
+    by asking, and notifications about libraries config.json doesn't know about yet trigger
+    a check for new libraries. After every (re)connection, the sections and the item index are
+    resynced from their last checkpoints, covering whatever happened while disconnected.
+    """
+
+    def __init__(self, cmd_args):
+        self.cmd_args = cmd_args
+        self.quiet = cmd_args.quiet
+        self.config = ConfigFile()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.connections = {}
+
+
+    def listen(self):
+        if not self.config.load():
+            print('Could not find config.json. Have you run configuration (-c)?')
+            return
+
+        servers = Scanner.get_servers(self.config.mappings)
+        if len(servers) == 0:
+            print('Notifications require the web API. Rerun configuration (-c) without --noweb.')
+            return
+
+        threads = [threading.Thread(target=self.run, args=(i,), daemon=True) for i in range(len(servers))]
+        for thread in threads:
+            thread.start()
+        self.log(f'Listening for notifications from {len(servers)} server(s). Press Ctrl+C to stop.')
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            for websocket in self.connections.values():
+                websocket.close()
+
+
+    def run(self, server_index):
+        """Listens to a single server, reconnecting with exponential backoff (and jitter) whenever the connection drops"""
+        from ScanInPlexItemIndex import ItemIndex
+        scanner = Scanner(self.cmd_args)
+        index = ItemIndex(Common.app_data_file('index.db')) # SQLite connections can't be shared between threads
+        delay = MIN_BACKOFF
+        try:
+            while not self.stopping.is_set():
+                mappings = self.load_config(scanner)
+                server = Scanner.get_servers(mappings)[server_index]
+                connected = time.monotonic()
+                try:
+                    websocket = WebSocket(f'{server["host"]}/:/websockets/notifications?X-Plex-Token={server["token"]}', PING_INTERVAL)
+                    with self.lock:
+                        self.connections[server_index] = websocket
+                    self.log(f'Connected to {server["host"]}')
+                    try:
+                        # Anything that arrives during the resync waits in the socket, so nothing is missed
+                        self.resync(scanner, index, server_index)
+                        while not self.stopping.is_set():
+                            message = websocket.recv()
+                            if message == None:
+                                break
+                            self.apply(scanner, index, server_index, message)
+                    finally:
+                        with self.lock:
+                            self.connections.pop(server_index, None)
+                        websocket.close()
+                except (OSError, ValueError, KeyError) as e:
+                    if not self.stopping.is_set():
+                        self.log(f'Lost connection to {server["host"]}: {e}')
+
+                if time.monotonic() - connected > HEALTHY_SECONDS:
+                    delay = MIN_BACKOFF
+                self.stopping.wait(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, MAX_BACKOFF)
+        finally:
+            index.close()
+
+
+    def resync(self, scanner, index, server_index):
+        """Catches up on everything that changed since the last checkpoints"""
+        self.refresh_sections(scanner)
+        mappings = self.load_config(scanner)
+        for section in mappings['sections']:
+            if section.get('server', 0) != server_index or index.get_sync_state(Scanner.index_key(section)) == None:
+                continue # Sections that were never indexed are indexed in full by their first refresh
+            media_type, _ = Scanner.item_type(section)
+            scanner.sync_index(index, section, Scanner.server_mappings(mappings, section), media_type)
+
+
+    def load_config(self, scanner):
+        """Returns the current config, reloading it if it changed and applying its request settings to the given scanner"""
+        self.config.load()
+        mappings = self.config.mappings
+        scanner.use_config(mappings)
+        return mappings
+
+
+    def refresh_sections(self, scanner):
+        updated = scanner.update_sections(self.load_config(scanner), 0)
+        if updated != None:
+            self.config.update(*updated)
+            self.log('Library folders changed. Updated config.json')
+
+
+    def apply(self, scanner, index, server_index, message):
+        """Applies a single notification to the cached state"""
+        try:
+            container = json.loads(message)['NotificationContainer']
+        except (ValueError, KeyError, TypeError):
+            return
+        if container.get('type') != 'timeline':
+            return
+
+        mappings = self.load_config(scanner)
+        for entry in container.get('TimelineEntry', []):
+            if entry.get('identifier') != 'com.plexapp.plugins.library' or 'itemID' not in entry:
+                continue
+
+            section = next((section for section in mappings['sections']
+                if section.get('server', 0) == server_index and section['section'] == str(entry.get('sectionID'))), None)
+            if section == None:
+                # Something happened in a library we don't know about, so it must be new
+                self.refresh_sections(scanner)
+                mappings = self.config.mappings
+                continue
+
+            key = Scanner.index_key(section)
+            state = index.get_sync_state(key)
+            if state == None:
+                continue # Not indexed, so there's nothing to keep up to date
+
+            media_type, _ = Scanner.item_type(section)
+            if entry.get('state') == STATE_DELETED:
+                index.remove(key, int(entry['itemID']))
+                self.log(f'Removed item {entry["itemID"]} from section {section["section"]}')
+            elif entry.get('state') == STATE_DONE and entry.get('type') == media_type:
+                server = Scanner.server_mappings(mappings, section)
+                item = scanner.web_get_json(f'{server["host"]}/library/metadata/{entry["itemID"]}?X-Plex-Token={server["token"]}')
+                if item != None and len(item.get('Metadata', [])) > 0:
+                    index.update(key, item['Metadata'], state[1])
+                    self.log(f'Updated item {entry["itemID"]} in section {section["section"]}')
+
+
+    def log(self, message):
+        if not self.quiet:
+            print(message, flush=True)
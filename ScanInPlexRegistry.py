@@ -0,0 +1,171 @@
+import os
+
+try:
+    import winreg
+except ImportError:
+    winreg = None
+
+# Keys are relative to HKEY_CLASSES_ROOT. The default value of a key is stored under the name ''
+ROOT_KEY = 'HKEY_CLASSES_ROOT'
+
+# Where folder context menu entries live
+SHELL_KEY = 'Directory\\shell'
+MENU_KEYS = [f'{SHELL_KEY}\\ScanInPlex', f'{SHELL_KEY}\\RefreshInPlex']
+
+def diff(desired, backend):
+    """
+    Compares the desired registry state ({ key : { name : value } }, or { key : None } for
+    keys that shouldn't exist) to what's currently installed, returning only what has to
+    change in the same format. Values that are already correct are left out, so an empty
+    result means there's nothing to do.
+    """
+
+    changes = {}
+    for key, values in desired.items():
+        installed = backend.read(key)
+        if values == None:
+            if installed != None:
+                changes[key] = None
+            continue
+
+        changed = { name : value for name, value in values.items() if installed == None or installed.get(name) != value }
+        if len(changed) > 0:
+            changes[key] = changed
+    return changes
+
+
+def describe(changes):
+    """Returns a human-readable list of the given changes"""
+    lines = []
+    for key, values in changes.items():
+        if values == None:
+            lines.append(f'Delete {ROOT_KEY}\\{key}')
+            continue
+        for name, value in values.items():
+            lines.append(f'Set {ROOT_KEY}\\{key} {name or "(Default)"} = {value}')
+    return lines
+
+
+class MemoryBackend:
+    """An in-memory registry, for exercising configuration without touching the real one"""
+
+    def __init__(self, keys=None):
+        self.keys = keys if keys != None else {}
+        self.applied = []
+
+
+    def read(self, key):
+        values = self.keys.get(key)
+        return dict(values) if values != None else None
+
+
+    def apply(self, changes):
+        self.applied.append(changes)
+        for key, values in changes.items():
+            if values == None:
+                for existing in [existing for existing in self.keys if existing == key or existing.startswith(key + '\\')]:
+                    del self.keys[existing]
+            else:
+                self.keys.setdefault(key, {}).update(values)
+        return True
+
+
+class WinregBackend:
+    """
+    Reads and writes the registry in-process via winreg. Writing to HKEY_CLASSES_ROOT requires
+    administrator privileges, but every change is made without spawning anything.
+    """
+
+    def read(self, key):
+        try:
+            handle = winreg.OpenKey(winreg.HKEY_CLASSES_ROOT, key)
+        except OSError:
+            return None
+
+        values = {}
+        with handle:
+            i = 0
+            while True:
+                try:
+                    name, value, _ = winreg.EnumValue(handle, i)
+                except OSError:
+                    break
+                values[name] = value
+                i += 1
+        return values
+
+
+    def apply(self, changes):
+        # Deleted keys can't have subkeys, so delete the deepest ones first
+        for key in sorted([key for key, values in changes.items() if values == None], key=len, reverse=True):
+            self.delete_tree(key)
+
+        for key, values in changes.items():
+            if values == None:
+                continue
+            with winreg.CreateKeyEx(winreg.HKEY_CLASSES_ROOT, key, 0, winreg.KEY_SET_VALUE) as handle:
+                for name, value in values.items():
+                    winreg.SetValueEx(handle, name, 0, winreg.REG_SZ, value)
+        return True
+
+
+    def delete_tree(self, key):
+        try:
+            with winreg.OpenKey(winreg.HKEY_CLASSES_ROOT, key) as handle:
+                subkeys = []
+                while True:
+                    try:
+                        subkeys.append(winreg.EnumKey(handle, len(subkeys)))
+                    except OSError:
+                        break
+        except OSError:
+            return # Already gone
+
+        for subkey in subkeys:
+            self.delete_tree(f'{key}\\{subkey}')
+        winreg.DeleteKey(winreg.HKEY_CLASSES_ROOT, key)
+
+
+class RegFileBackend(WinregBackend):
+    """
+    Reads the registry via winreg (which doesn't need elevation), but applies changes by writing
+    them all to a single .reg file and launching it, which results in one UAC/regedit prompt.
+    Used when not running as an administrator.
+    """
+
+    def __init__(self, reg_file='_scanInPlex.tmp.reg'):
+        self.reg_file = reg_file
+
+
+    @staticmethod
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+    @staticmethod
+    def to_text(changes):
+        text = 'Windows Registry Editor Version 5.00\n'
+        for key, values in changes.items():
+            if values == None:
+                text += f'\n[-{ROOT_KEY}\\{key}]\n'
+                continue
+
+            text += f'\n[{ROOT_KEY}\\{key}]\n'
+            for name, value in values.items():
+                name = '@' if name == '' else f'"{RegFileBackend.escape(name)}"'
+                text += f'{name}="{RegFileBackend.escape(value)}"\n'
+        return text
+
+
+    def apply(self, changes):
+        with open(self.reg_file, 'w') as reg:
+            reg.write(RegFileBackend.to_text(changes))
+
+        os.system(f'.\\{self.reg_file}')
+        os.remove(self.reg_file)
+        return True
+
+
+def get_backend(is_admin):
+    """Returns the backend to use for the real registry"""
+    return WinregBackend() if is_admin else RegFileBackend()
@@ -1,125 +1,1170 @@
+# Every click in Explorer starts a new process, and most of them only need to read config.json
+# and send a single request. Anything that's slow to import and not needed on every path
+# (requests in particular) is imported where it's used instead of here.
 import argparse
+import contextlib
 import json
 import os
-import requests
 import ScanInPlexCommon as Common
-import subprocess
+import sys
+import threading
+from ScanInPlexIndex import RootIndex, normalize_path, parse_sections, path_key
+from ScanInPlexTrace import Trace
+import time
 import urllib.parse
 
+DEFAULT_BROKER_WINDOW = 1.0
+DEFAULT_BROKER_MAX_WAIT = 10.0
+DEFAULT_BUSY_WAIT = 120
+DEFAULT_CONNECT_TIMEOUT = 3
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_WEB_RETRIES = 2
+DEFAULT_CIRCUIT_THRESHOLD = 3
+DEFAULT_CIRCUIT_COOLDOWN = 300
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_REFRESH_CONCURRENCY = 4
+DEFAULT_REFRESH_STRATEGY = 'per-item'
+DEFAULT_FORCED_REFRESH_THRESHOLD = 20
+DEFAULT_SECTIONS_TTL = 86400
+DEFAULT_SECTIONS_RETRY = 60
+DEFAULT_SCAN_FAN_OUT = 10
+DEFAULT_SCAN_CONCURRENCY = 4
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_REQUEST_RATE = 100
+DEFAULT_SLOW_LATENCY = 2
+
+# The base delay between retries, doubled after every attempt
+RETRY_BACKOFF = 0.5
+
+# How long to wait for a scan we just requested to show up in the server's activities
+STARTUP_GRACE = 5
+
+# The only item fields refresh needs. Servers that don't support field projection
+# ignore this and return full items, which is still correct, just larger.
+ITEM_FIELDS = 'ratingKey,parentRatingKey,grandparentRatingKey,updatedAt,file,size'
+
+# An item's own key, followed by the keys of its ancestors (e.g. episode, season, show)
+HIERARCHY_KEYS = ['ratingKey', 'parentRatingKey', 'grandparentRatingKey']
+
+# The most ids to ask about in a single /library/metadata/{ids} request
+METADATA_BATCH_SIZE = 50
+
+# Ways to refresh the items under a folder, see Scanner.refresh
+REFRESH_STRATEGIES = ['auto', 'forced-path', 'per-item']
+
+# The config.json settings applied by Scanner.use_config
+REQUEST_SETTINGS = ['trace', 'trace_max_kb', 'connect_timeout', 'read_timeout', 'web_retries', 'circuit_threshold', 'circuit_cooldown',
+    'max_in_flight', 'max_request_rate', 'slow_latency']
+
 class Scanner:
     def __init__(self, cmd_args=None):
         self.valid = True
+        self.session = None
+        self.pool_size = 0 # Connections the session keeps to each server, see get_session
+        self.local = threading.local() # Keep-alive connections, which can't be shared between threads
+        self.trace = Trace()
+        self.timeouts = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+        self.retries = DEFAULT_WEB_RETRIES
+        self.breaker = None
+        self.governor = None
+        self.request_settings = None
+        self.machine_identifiers = {} # Each server's machineIdentifier, by host
         self.cmd_args = cmd_args
         if self.cmd_args == None:
             parser = argparse.ArgumentParser()
             parser.add_argument('-d', '--directory')
             parser.add_argument('-r', '--refresh_metadata', action='store_true')
+            parser.add_argument('--wait', action='store_true')
             self.cmd_args = parser.parse_args()
 
         if 'directory' not in self.cmd_args:
             self.valid = False
             return
 
-        self.dir = self.cmd_args.directory
+        # The command line accepts any number of directories (-d, which may be repeated, and --from-file),
+        # the context menu exactly one
+        directories = self.cmd_args.directory
+        self.directories = directories if isinstance(directories, list) else [directories] if directories != None else []
+        if getattr(self.cmd_args, 'from_file', None):
+            self.directories.extend(Scanner.read_directories(self.cmd_args.from_file))
+        self.dir = self.directories[0] if len(self.directories) > 0 else None
         self.refresh_metadata = self.cmd_args.refresh_metadata
+        self.wait = getattr(self.cmd_args, 'wait', False)
+        self.dry_run = getattr(self.cmd_args, 'dry_run', False)
+        self.fan_out = getattr(self.cmd_args, 'fan_out', None)
+        self.refresh_strategy = getattr(self.cmd_args, 'refresh_strategy', None)
+
+        # Only coalesce with other scanner processes when launched directly by the context menu
+        self.use_broker = cmd_args == None
+
+    @staticmethod
+    def read_directories(path):
+        """Returns the directories listed one per line in the given file, or stdin if path is '-'"""
+        if path == '-':
+            return [line.strip() for line in sys.stdin if line.strip()]
+        with open(path, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+
 
     def process(self):
         """
-        Attempts to scan/refresh the passed in library directory. Fails silently
+        Attempts to scan/refresh the passed in library directories. Fails silently
         """
 
-        if not self.valid:
+        if not self.valid or len(self.directories) == 0:
             return
-        config_file = Common.adjacent_file('config.json')
-        if not os.path.exists(config_file):
+        start = time.perf_counter()
+        mappings, index = Scanner.load_config()
+        if mappings == None:
+            return
+        # The rest of the request settings (see use_config) wait until there's something to send,
+        # so a click outside of every library doesn't pay for them
+        self.trace = Trace.for_config(mappings, Common.app_data_file('trace.log'))
+        self.trace.record('config', start, sections=len(mappings['sections']))
+
+        start = time.perf_counter()
+        unmatched = [directory for directory in self.directories if index.lookup(directory) == None]
+        self.trace.record('match', start, matched=len(unmatched) == 0)
+        updated = None
+        if len(unmatched) > 0:
+            # The folder may have been added to a library since configuration
+            updated = self.update_sections(mappings, mappings.get('sections_retry', DEFAULT_SECTIONS_RETRY))
+            if updated != None:
+                mappings, index = updated
+                unmatched = [directory for directory in unmatched if index.lookup(directory) == None]
+
+        if len(unmatched) == len(self.directories) and not self.dry_run:
+            return
+
+        self.submit(mappings, index, [directory for directory in self.directories if directory not in unmatched])
+
+        # Libraries can also change in ways that don't result in a miss (e.g. a folder moving to another
+        # library), so check every once in a while, but only after the request is out of the way
+        ttl = mappings.get('sections_ttl', DEFAULT_SECTIONS_TTL)
+        if updated == None and ttl > 0:
+            self.update_sections(mappings, ttl)
+
+
+    def submit(self, mappings, index, directories):
+        """Sends the requests for the given directories, either directly or via the broker"""
+        requests = [{ 'directory' : directory, 'refresh' : self.refresh_metadata } for directory in directories]
+        if self.dry_run:
+            self.print_plan(self.plan(requests, mappings, index), mappings, [directory for directory in self.directories if directory not in directories])
             return
+        if not self.use_broker:
+            self.process_batch(requests, mappings, index)
+            return
+
+        from ScanInPlexBroker import Broker, Spool
+
+        # Spool the request before anything else so it isn't lost if something goes wrong, then
+        # let the broker (possibly us) send it along with anything else that's pending.
+        spool = Spool(Common.app_data_file('spool'))
+        for request in requests:
+            spool.add(request)
+        broker = Broker(Common.app_data_file('broker.lock'),
+            mappings.get('broker_window', DEFAULT_BROKER_WINDOW),
+            mappings.get('broker_max_wait', DEFAULT_BROKER_MAX_WAIT))
+        flush = lambda: self.flush_spool(spool, mappings, index)
+        if not broker.run(flush):
+            flush()
+
+
+    def flush_spool(self, spool, mappings, index):
+        """Processes every pending request in the spool, including any left behind by a crash"""
+        entries = spool.load()
+
+        # Another scanner may have updated the library sections after we loaded them
+        latest = Scanner.load_config()
+        if latest[0] != None:
+            mappings, index = latest
+        self.process_batch([request for _, request in entries], mappings, index)
+        spool.remove([name for name, _ in entries])
+
+
+    @staticmethod
+    def load_config():
+        """Returns the contents of config.json and the section root index, or (None, None) if there's no config.json"""
+        config_file = Common.app_data_file('config.json')
+        if not os.path.exists(config_file):
+            return None, None
 
-        config_string = ''
         with open(config_file, 'r') as f:
-            config_string = ''.join(f.readlines())
-
-        mappings = json.loads(config_string)
-        section_id = -1
-        section = None
-        dir_lower = self.dir.lower()
-        for section in mappings['sections']:
-            for path in [p.lower() for p in section['paths']]:
-
-                # Passed in directory must start with one our our root folders, but not make sure to ignore
-                # partial matches (e.g. Z:\Movies2\SomeFolder compared to Z:\Movies)
-                if dir_lower.startswith(path) and (len(dir_lower) == len(path) or dir_lower[len(path)] == '\\'):
-                    section_id = section['section']
-                    section = section
-                    break
-            if section_id != -1:
-                break
+            mappings = json.load(f)
+
+        # Older configurations don't have a precompiled index, so build one on the fly
+        drives = mappings.get('drives')
+        index = RootIndex(mappings['index'], drives) if 'index' in mappings else RootIndex.build(mappings['sections'], drives)
+        return mappings, index
+
+
+    def update_sections(self, mappings, max_age):
+        """
+        Re-fetches the server's library sections if they haven't been checked (by any scanner) in the
+        last max_age seconds. If they changed, config.json is atomically rewritten with them, and the
+        new (mappings, index) are returned. Otherwise returns None.
+        """
+
+        servers = Scanner.get_servers(mappings)
+        if len(servers) == 0:
+            return None
+
+        # The modification time of an empty marker file records the last check. Claim the check
+        # before making it, so other scanners that miss at the same time don't repeat it
+        marker = Common.app_data_file('sections.checked')
+        try:
+            if time.time() - os.stat(marker).st_mtime < max_age:
+                return None
+        except OSError:
+            pass
+        try:
+            with open(marker, 'a'):
+                pass
+            os.utime(marker)
+        except OSError:
+            return None
+
+        self.use_config(mappings)
+        start = time.perf_counter()
+        sections = []
+        for i in range(len(servers)):
+            server = servers[i]
+            server_sections = None
+            if not self.breaker.is_open(server['host']):
+                container = self.web_get_json(f'{server["host"]}/library/sections?X-Plex-Features=external-media%2Cindirect-media&X-Plex-Token={server["token"]}')
+                server_sections = parse_sections(container)
+            if server_sections == None:
+                # Keep what we know about a server we can't reach right now
+                server_sections = [section for section in mappings['sections'] if section.get('server', 0) == i]
+            sections.extend(dict(section, server=i) for section in server_sections)
+
+        changed = sections != mappings['sections']
+        self.trace.record('sections', start, changed=changed)
+        if not changed:
+            return None
+
+        drives = mappings.get('drives')
+        mappings = dict(mappings, sections=sections, index=RootIndex.build(sections, drives).to_json())
+        config_file = Common.app_data_file('config.json')
+        temp = f'{config_file}.{os.getpid()}.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(mappings, f)
+            os.replace(temp, config_file)
+        except OSError:
+            pass # We can still use them ourselves
+        return mappings, RootIndex(mappings['index'], drives)
+
+
+    @staticmethod
+    def get_servers(mappings):
+        """Returns the servers ({ 'host', 'token' }) in the given config, which is empty if the web API isn't used"""
+        if 'servers' in mappings:
+            return mappings['servers']
+        if 'host' in mappings and 'token' in mappings:
+            return [{ 'host' : mappings['host'], 'token' : mappings['token'] }]
+        return []
+
+
+    @staticmethod
+    def server_mappings(mappings, section):
+        """
+        Returns the config to use for requests about the given section, i.e. with the host and token of
+        the server that owns it. Only the first server (the one on this machine) can fall back to
+        Plex Media Scanner.exe, since section ids mean nothing to another server's scanner. Without
+        the web API (or if the server is no longer listed), another server's sections can't be
+        reached at all, so their config has no host or token.
+        """
+
+        server = section.get('server', 0)
+        if server == 0:
+            return mappings
+        servers = Scanner.get_servers(mappings)
+        if server >= len(servers):
+            return dict({ key : value for key, value in mappings.items() if key not in ['host', 'token'] }, remote=True)
+        return dict(mappings, host=servers[server]['host'], token=servers[server]['token'], remote=True)
+
 
-        if section_id == -1:
+    @staticmethod
+    def index_key(section):
+        """Returns the key the item index stores a section under. Section ids are only unique per server"""
+        server = section.get('server', 0)
+        return section['section'] if server == 0 else f'{server}:{section["section"]}'
+
+
+    def use_config(self, mappings):
+        """
+        Applies config.json settings that affect how requests are made, if they haven't been already.
+        Long-running modes call this with every config they reload, so only changes are re-applied.
+        """
+
+        settings = [mappings.get(key) for key in REQUEST_SETTINGS]
+        if self.breaker != None and settings == self.request_settings:
             return
+        self.request_settings = settings
+
+        self.trace = Trace.for_config(mappings, Common.app_data_file('trace.log'))
+        self.timeouts = (mappings.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT), mappings.get('read_timeout', DEFAULT_READ_TIMEOUT))
+        self.retries = mappings.get('web_retries', DEFAULT_WEB_RETRIES)
+        from ScanInPlexCircuit import CircuitBreaker
+        self.breaker = CircuitBreaker(Common.app_data_file('circuit.json'),
+            mappings.get('circuit_threshold', DEFAULT_CIRCUIT_THRESHOLD),
+            mappings.get('circuit_cooldown', DEFAULT_CIRCUIT_COOLDOWN))
+        self.governor = None
+        if mappings.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT) > 0:
+            from ScanInPlexGovernor import Governor
+            self.governor = Governor(Common.app_data_file('governor'),
+                mappings.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT),
+                mappings.get('max_request_rate', DEFAULT_MAX_REQUEST_RATE),
+                mappings.get('slow_latency', DEFAULT_SLOW_LATENCY))
+
+
+    def process_batch(self, batch, mappings, index):
+        """Scans/refreshes a batch of requests, as planned by plan()"""
+        self.use_config(mappings)
+        self.run_plan(self.plan(batch, mappings, index), mappings)
 
-        if self.refresh_metadata:
-            # refresh_metadata implies --web. Something's gone wrong if token/host aren't present, but ignore it
-            self.refresh(section, mappings)
-        else:
-            self.scan(section_id, mappings)
 
+    def plan(self, batch, mappings, index):
+        """
+        Works out what to send for a batch of requests, returning { (section position, refresh) : [directories] }.
+        Each directory is only handled once, no matter how many times it was requested, and directories
+        whose ancestor is also in the batch are skipped, since the ancestor already covers them. For
+        scans, many sibling folders are also combined into a single scan of their parent.
+        """
+
+        grouped = {}
+        for request in batch:
+            match = index.lookup(request['directory'])
+            if match != None:
+                directory = Scanner.plex_path(request['directory'], mappings['sections'][match]['paths'], index.drives)
+                directories = grouped.setdefault((match, request['refresh']), {})
+                directories.setdefault(path_key(directory), directory)
+
+        fan_out = self.fan_out if self.fan_out != None else mappings.get('scan_fan_out', DEFAULT_SCAN_FAN_OUT)
+        plan = {}
+        for (match, refresh), directories in grouped.items():
+            directories = Scanner.without_descendants(directories)
+            if not refresh:
+                directories = Scanner.collapse_siblings(directories, mappings['sections'][match]['paths'], fan_out)
+            plan[(match, refresh)] = list(directories.values())
+        return plan
+
+
+    @staticmethod
+    def collapse_siblings(directories, roots, fan_out):
+        """
+        Given a dict of path_key -> directory with no directory under another, replaces every group of more
+        than fan_out directories that share a parent with that parent (as long as it's still in the library),
+        repeating until there's nothing left to combine. 0 disables combining.
+        """
 
-    def scan(self, section_id, mappings):
-        if 'token' in mappings and 'host' in mappings:
+        if fan_out <= 0:
+            return directories
+
+        root_keys = [path_key(root) for root in roots]
+        while True:
+            siblings = {}
+            for key, directory in directories.items():
+                parent_key = key[:key.rfind('\\')]
+                if any(parent_key == root or parent_key.startswith(root + '\\') for root in root_keys):
+                    siblings.setdefault(parent_key, []).append(key)
+
+            crowded = { parent : keys for parent, keys in siblings.items() if len(keys) > fan_out }
+            if len(crowded) == 0:
+                return directories
+
+            for parent_key, keys in crowded.items():
+                directory = directories[keys[0]]
+                parent = directory[:max(directory.rfind('\\'), directory.rfind('/'))]
+                for key in keys:
+                    del directories[key]
+                directories[parent_key] = parent
+            directories = Scanner.without_descendants(directories)
+
+
+    def print_plan(self, plan, mappings, unmatched):
+        for (match, refresh), directories in plan.items():
+            section = mappings['sections'][match]
+            print(f'Section {section["section"]} ({section["type"]}): {len(directories)} {"refresh" if refresh else "scan"}(s)')
+            for directory in directories:
+                print(f'  {directory}')
+        if len(unmatched) > 0:
+            print('Not in any library:')
+            for directory in unmatched:
+                print(f'  {directory}')
+
+
+    def run_plan(self, plan, mappings):
+        for (match, refresh), directories in plan.items():
+            section = mappings['sections'][match]
+            server = Scanner.server_mappings(mappings, section)
+            if not refresh and 'host' in server:
+                # Partial scans started while the whole section is being scanned just make
+                # the server thrash, so queue up behind any scan that's already running
+                self.wait_until_idle(section['section'], server, server.get('busy_wait', DEFAULT_BUSY_WAIT))
+
+            if refresh:
+                # refresh_metadata implies --web. Something's gone wrong if token/host aren't present, but ignore it.
+                # Each refresh already sends its items concurrently, so do one directory at a time.
+                if 'token' not in server:
+                    continue
+                for directory in directories:
+                    self.refresh(section, server, directory)
+            elif len(directories) == 1:
+                self.scan(section['section'], server, directories[0])
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=server.get('scan_concurrency', DEFAULT_SCAN_CONCURRENCY)) as pool:
+                    list(pool.map(lambda directory: self.scan(section['section'], server, directory), directories))
+
+            if not refresh and self.wait and 'host' in server:
+                elapsed = self.wait_until_idle(section['section'], server, None, True)
+                print(f'Scan of section {section["section"]} finished after {elapsed:.1f} seconds')
+
+
+    def wait_until_idle(self, section_id, mappings, max_wait, wait_for_start=False):
+        """
+        Waits, polling with backoff, until the server isn't scanning the given section, or until
+        max_wait seconds have passed (if given). If wait_for_start is set, a scan we just asked for
+        is assumed to be on its way even if it hasn't shown up yet, so keep waiting for it for a
+        few seconds before deciding it's done. Returns the number of seconds waited.
+        """
+
+        start = time.monotonic()
+        delay = 0.5
+        seen_busy = False
+        while True:
+            elapsed = time.monotonic() - start
+            if self.section_busy(section_id, mappings):
+                seen_busy = True
+            elif seen_busy or not wait_for_start or elapsed >= STARTUP_GRACE:
+                return elapsed
+
+            if max_wait != None and elapsed >= max_wait:
+                return elapsed
+
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+
+
+    def section_busy(self, section_id, mappings):
+        """Returns whether the server reports that it's currently scanning the given section"""
+        if self.breaker.is_open(mappings['host']):
+            return False # The server's unreachable, so we'll be falling back to the .exe anyway
+
+        start = time.perf_counter()
+        busy = self.check_section_busy(section_id, mappings)
+        self.trace.record('scan.busy', start, section=section_id, busy=busy)
+        return busy
+
+
+    def check_section_busy(self, section_id, mappings):
+        token = mappings['token']
+        host = mappings['host']
+        activities = self.web_get_json(f'{host}/activities?X-Plex-Token={token}')
+        if activities != None:
+            for activity in activities.get('Activity', []):
+                context = activity.get('Context', {})
+                if activity.get('type', '').startswith('library.update.section') and str(context.get('librarySectionID')) == str(section_id):
+                    return True
+
+        sections = self.web_get_json(f'{host}/library/sections?X-Plex-Token={token}')
+        if sections != None:
+            for section in sections.get('Directory', []):
+                if section.get('key') == section_id and section.get('refreshing') in [True, 1, '1']:
+                    return True
+
+        return False
+
+
+    @staticmethod
+    def plex_path(directory, roots, drives=None):
+        """
+        Returns the given directory spelled the way Plex knows it, i.e. relative to the deepest of the
+        given roots that contains it, using that root exactly as Plex reported it. This takes care of
+        case, separators, and mapped drive vs. network share differences between the two.
+        """
+
+        target = RootIndex.split(directory, drives)
+        matches = [(root, RootIndex.split(root, drives)) for root in roots]
+        matches = [(root, components) for root, components in matches if target[:len(components)] == components]
+        if len(matches) == 0:
+            return normalize_path(directory)
+
+        root, components = max(matches, key=lambda match: len(match[1]))
+        separator = '/' if '/' in root and '\\' not in root else '\\'
+        rest = normalize_path(directory, drives).split('\\')[len(components):]
+        return separator.join([root.rstrip('\\/') or root] + rest)
+
+
+    @staticmethod
+    def without_descendants(directories):
+        """Filters a dict of path_key -> directory down to the directories that aren't under any other one"""
+        kept = {}
+        for key in sorted(directories, key=len):
+            components = key.split('\\')
+            if not any('\\'.join(components[:i]) in kept for i in range(1, len(components))):
+                kept[key] = directories[key]
+        return kept
+
+
+    def scan(self, section_id, mappings, directory=None):
+        directory = directory or self.dir
+        self.use_config(mappings)
+        if 'token' in mappings and 'host' in mappings and self.breaker.allow(mappings['host'], lambda: self.probe(mappings['host'])):
             token = mappings['token']
             host = mappings['host']
-            webapi = f'{host}/library/sections/{section_id}/refresh?path={urllib.parse.quote(self.dir)}&X-Plex-Token={token}'
-            result = requests.get(webapi).status_code
+            webapi = f'{host}/library/sections/{section_id}/refresh?path={urllib.parse.quote(directory)}&X-Plex-Token={token}'
+            start = time.perf_counter()
+            result, body = self.web_get_with_retry(webapi)
+            self.trace.record('scan.web', start, section=section_id, status=result, bytes=len(body or b''))
+            # Only count Plex being unreachable or failing against the web API. Anything else (e.g. a 404 for a section that's
+            # gone) is specific to this request, and shouldn't send every other scan to the .exe (or nowhere) for a while
+            if result == None or result >= 500:
+                self.breaker.failure(host)
+            else:
+                self.breaker.success(host)
             if result == 200: # On error, fallback to the .exe
                 return
 
+        if mappings.get('remote', False) or mappings.get('exe') == None:
+            return # The local scanner can't scan another server's libraries, and there's no scanner outside of Windows
+
+        import subprocess
         exe = mappings['exe']
-        cmd = f'"{exe}" -s -c {section_id} -d "{self.dir}"'
+        cmd = f'"{exe}" -s -c {section_id} -d "{directory}"'
         CREATE_NO_WINDOW = 0x08000000 # Don't show any output
-        subprocess.call(cmd, creationflags=CREATE_NO_WINDOW)
+        start = time.perf_counter()
+        exit_code = subprocess.call(cmd, creationflags=CREATE_NO_WINDOW)
+        self.trace.record('scan.exe', start, section=section_id, exit_code=exit_code)
+
 
+    def refresh(self, section, mappings, directory=None):
+        """
+        Refresh metadata for all items in the requested directory, using one of the REFRESH_STRATEGIES (refresh_strategy):
+          forced-path: Ask for a single forced refresh of the directory, which covers everything under it without having to find it first.
+          per-item:    Find the items under the directory and refresh each of them (or their seasons, shows, or artists) one by one.
+          auto:        forced-path if there are at least refresh_forced_threshold items to refresh, per-item otherwise. Never
+                       forced-path with refresh_changed_only, since a forced refresh can't skip unchanged items.
+        Whenever the server rejects a forced refresh, the items are refreshed one by one instead.
+        """
 
-    def refresh(self, section, mappings):
-        """Refresh metadata for all items in the requested directory"""
-        # Inefficient, but do the following:
-        # 1: Get all items in a given library with the right type
-        # 2: Parse all paths and build up list of metadata ids
-        # 3: Make a request for each metadata id to refresh
+        directory = directory or self.dir
         token = mappings['token']
         host = mappings['host']
-        media_type = 1 # Default to refreshing individual movies
-        refresh_key = 'ratingKey'
+        media_type, refresh_key = Scanner.item_type(section)
+        strategy = self.refresh_strategy or mappings.get('refresh_strategy', DEFAULT_REFRESH_STRATEGY)
+        threshold = mappings.get('refresh_forced_threshold', DEFAULT_FORCED_REFRESH_THRESHOLD)
+        changed_only = mappings.get('refresh_changed_only', False)
+        auto = strategy == 'auto' and not changed_only
+
+        start = time.perf_counter()
+        estimate = self.estimate_items(section, mappings, directory, media_type, refresh_key) if auto else None
+        if strategy == 'forced-path' or (estimate != None and estimate >= threshold):
+            if self.refresh_path(section, mappings, directory):
+                return self.report_forced_refresh(section, directory, strategy, estimate, start)
+            auto = False # Rejected, so don't try again once the items are found
+
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        # Refreshes are independent of each other, so send a bounded number of them at once
+        # over a shared keep-alive session instead of waiting on each one in turn
+        concurrency = mappings.get('refresh_concurrency', DEFAULT_REFRESH_CONCURRENCY)
+        session = self.get_session(concurrency)
+
+        skipped = set()
+        selected = Scanner.select_items(self.find_items(section, mappings, directory, media_type, refresh_key), changed_only, skipped)
+        if section['type'] in ['show', 'artist']:
+            metadata_ids = self.plan_refresh(section, mappings, dict(selected), refresh_key)
+        else:
+            metadata_ids = (metadata_id for metadata_id, _ in selected) # Movies have no parents, so start refreshing right away
+
+        if auto and estimate == None:
+            # There was no cheap way to tell how many items there are, but now that they've been found,
+            # a single forced refresh still beats refreshing enough of them one by one
+            metadata_ids = list(metadata_ids)
+            if len(metadata_ids) >= threshold and self.refresh_path(section, mappings, directory):
+                return self.report_forced_refresh(section, directory, strategy, len(metadata_ids), start)
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = { pool.submit(self.refresh_item, session, host, token, metadata_id) : metadata_id for metadata_id in metadata_ids }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+        self.trace.record('refresh.per-item', start, section=section['section'], strategy=strategy, items=len(results), skipped=len(skipped),
+            failed=sum(1 for error in results.values() if error != None))
+        self.report_refresh(results, skipped if changed_only else None, time.perf_counter() - start)
+        return results
+
+
+    def estimate_items(self, section, mappings, directory, media_type, refresh_key):
+        """
+        Returns roughly how many items under the given directory would be refreshed one by one, if that can be
+        told without finding them: the item index knows if it holds the section, and a library root holds
+        (nearly) every item in its section. Returns None otherwise.
+        """
+
+        path = Common.app_data_file('index.db')
+        if os.path.exists(path):
+            from ScanInPlexItemIndex import ItemIndex
+            index = ItemIndex(path)
+            try:
+                key = Scanner.index_key(section)
+                if index.get_sync_state(key) != None:
+                    level = HIERARCHY_KEYS.index(refresh_key)
+                    return len(set(row[level] for row in index.find(key, directory)))
+            finally:
+                index.close()
+
+        if any(path_key(root) == path_key(directory) for root in section['paths']):
+            try:
+                return self.get_section_count(mappings['host'], mappings['token'], section['section'], media_type)
+            except Exception:
+                pass
+        return None
+
+
+    def refresh_path(self, section, mappings, directory):
+        """Asks the server to refresh everything under the given directory in a single forced refresh. Returns whether it accepted"""
+        webapi = f'{mappings["host"]}/library/sections/{section["section"]}/refresh?force=1&path={urllib.parse.quote(directory)}&X-Plex-Token={mappings["token"]}'
+        start = time.perf_counter()
+        status, _ = self.web_get_with_retry(webapi)
+        self.trace.record('refresh.forced', start, section=section['section'], status=status)
+        return status == 200
+
+
+    def report_forced_refresh(self, section, directory, strategy, estimate, start):
+        self.trace.record('refresh.forced-path', start, section=section['section'], strategy=strategy, estimate=estimate)
+        print(f'Refreshed everything under {directory} with a single forced refresh in {time.perf_counter() - start:.2f} seconds')
+        return {}
+
+
+    @staticmethod
+    def item_type(section):
+        """Returns the type of item to list for a section (which is the type the item index holds), and the key of those items to refresh"""
         if section['type'] == 'show':
-            media_type = 4 # Refresh individual episodes
-        elif section['type'] == 'artist':
-            media_type = 10 # Refresh albums, but need to grab individual tracks to get file paths. This is slow.
-            refresh_key = 'parentRatingKey'
-        # Photo albums don't work. This should probably be filtered out during configuration.
-
-        url = f'{host}/library/sections/{section["section"]}/all?type={media_type}&X-Plex-Token={token}'
-        response = requests.get(url, headers={ 'Accept' : 'application/json' })
-        json_response = {}
+            return 4, 'ratingKey' # Refresh individual episodes
+        if section['type'] == 'artist':
+            return 10, 'parentRatingKey' # Refresh albums, but need to grab individual tracks to get file paths. This is slow.
+        # Default to refreshing individual movies. Photo albums don't work. This should probably be filtered out during configuration.
+        return 1, 'ratingKey'
+
+
+    def plan_refresh(self, section, mappings, selected, refresh_key):
+        """
+        Returns the ids to refresh for the given { id : [ancestor ids] } (e.g. episode : [season, show]),
+        refreshing a parent once instead of each of its children when all of them were selected, i.e.
+        the whole season or show is under the directory (and changed, with refresh_changed_only).
+        """
+
+        start = time.perf_counter()
+        members = {}
+        for metadata_id, ancestors in selected.items():
+            for ancestor in ancestors:
+                if ancestor != None:
+                    members.setdefault(ancestor, []).append(metadata_id)
+
+        # Replacing a single child with its parent doesn't save anything, so only look up parents of several
+        # children. Episodes are counted by every ancestor's leafCount, albums by their artist's childCount
+        count_key = 'leafCount' if refresh_key == 'ratingKey' else 'childCount'
+        candidates = [ancestor for ancestor, children in members.items() if len(children) > 1]
+        totals = {}
+        lookups = 0
+        for i in range(0, len(candidates), METADATA_BATCH_SIZE):
+            ids = ','.join(str(ancestor) for ancestor in candidates[i:i + METADATA_BATCH_SIZE])
+            container = self.web_get_json(f'{mappings["host"]}/library/metadata/{ids}?X-Plex-Token={mappings["token"]}')
+            lookups += 1
+            for item in (container or {}).get('Metadata', []):
+                if count_key in item:
+                    totals[int(item['ratingKey'])] = int(item[count_key])
+
+        plan = Scanner.collapse_hierarchy(selected, totals)
+        saved = len(selected) - len(plan) - lookups
+        self.trace.record('refresh.plan', start, section=section['section'], items=len(selected), requests=len(plan), lookups=lookups, saved=saved)
+        if len(plan) < len(selected):
+            print(f'Refreshing {len(plan)} items instead of {len(selected)} by refreshing their parents, saving {saved} requests')
+        return plan
+
+
+    @staticmethod
+    def collapse_hierarchy(selected, totals):
+        """
+        Given { id : [ancestor ids] } and the number of children (at the level of the ids) each ancestor
+        has on the server, returns the ids to refresh, starting from the top: an ancestor all of whose
+        children were selected is refreshed instead of them, and anything below it is left out.
+        """
+
+        remaining = dict(selected)
+        plan = []
+        for level in reversed(range(max((len(ancestors) for ancestors in selected.values()), default=0))):
+            children = {}
+            for metadata_id, ancestors in remaining.items():
+                if len(ancestors) > level and ancestors[level] != None:
+                    children.setdefault(ancestors[level], []).append(metadata_id)
+            for ancestor, ids in children.items():
+                if len(ids) > 1 and totals.get(ancestor) == len(ids):
+                    plan.append(ancestor)
+                    for metadata_id in ids:
+                        del remaining[metadata_id]
+        return plan + list(remaining)
+
+
+    @staticmethod
+    def select_items(candidates, changed_only, skipped):
+        """
+        Yields (id, [ancestor ids]) for every item to refresh once, given (id, updatedAt, [(file, size)],
+        [ancestor ids]) for each item (or track, for albums) found under the directory. If changed_only is
+        set, items whose files all look the same as when Plex last updated them are left out, and added
+        to skipped instead.
+        """
+
+        refreshed = set()
+        for metadata_id, updated_at, parts, ancestors in candidates:
+            if metadata_id in refreshed:
+                continue
+            if changed_only and not any(Scanner.file_changed(file, size, updated_at) for file, size in parts):
+                skipped.add(metadata_id)
+                continue
+
+            # An album is refreshed if any of its tracks changed, even if others didn't
+            skipped.discard(metadata_id)
+            refreshed.add(metadata_id)
+            yield metadata_id, ancestors
+
+
+    @staticmethod
+    def file_changed(file, size, updated_at):
+        """
+        Returns whether a file differs from what Plex knows about it, i.e. its size is different, or
+        it was modified after its item was last updated. When in doubt (e.g. Plex hasn't analyzed the
+        file yet, or it can't be reached from here), it's considered changed.
+        """
+
+        if size == None:
+            return True
         try:
-            json_response = json.loads(response.content)['MediaContainer']
-        except:
-            return
+            stat = os.stat(file)
+        except OSError:
+            return True
+        return stat.st_size != int(size) or (updated_at != None and stat.st_mtime > int(updated_at))
+
+
+    @staticmethod
+    def item_candidate(item, refresh_key, prefix=None):
+        """
+        Returns (id, updatedAt, [(file, size)], [ancestor ids]) for an item from a listing, keeping only
+        files under the given path_key prefix (if any), or None if it doesn't have any of those
+        """
+
+        parts = []
+        for version in item.get('Media', []):
+            for part in version.get('Part', []):
+                if 'file' in part and (prefix == None or (path_key(part['file']) + '\\').startswith(prefix)):
+                    parts.append((part['file'], part.get('size')))
+        if len(parts) == 0 or refresh_key not in item:
+            return None
+        ancestors = [int(item[key]) if key in item else None for key in HIERARCHY_KEYS[HIERARCHY_KEYS.index(refresh_key) + 1:]]
+        return int(item[refresh_key]), item.get('updatedAt'), parts, ancestors
+
+
+    def refresh_item(self, session, host, token, metadata_id):
+        """Refreshes a single item, returning None on success or a description of what went wrong"""
+        start = time.perf_counter()
+        try:
+            with self.governed(host) as request:
+                response = session.put(f'{host}/library/metadata/{metadata_id}/refresh?X-Plex-Token={token}', timeout=self.timeouts)
+                response.close()
+                request.ok = response.status_code < 500
+            self.trace.record('refresh.put', start, item=metadata_id, status=response.status_code)
+            return None if response.status_code == 200 else f'HTTP {response.status_code}'
+        except Exception as e:
+            self.trace.record('refresh.put', start, item=metadata_id, error=str(e))
+            return str(e)
+
+
+    def report_refresh(self, results, skipped=None, elapsed=None):
+        """Prints the outcome of each refresh. Does nothing when run without a console (i.e. via pythonw)"""
+        failed = { metadata_id : error for metadata_id, error in results.items() if error != None }
+        print(f'Refreshed {len(results) - len(failed)} of {len(results)} items' + (f' in {elapsed:.2f} seconds' if elapsed != None else ''))
+        if skipped != None:
+            print(f'Skipped {len(skipped)} unchanged items')
+        for metadata_id, error in failed.items():
+            print(f'  Failed to refresh {metadata_id}: {error}')
+
+
+    def probe(self, host):
+        """Cheaply checks whether the server is reachable again, without retrying"""
+        start = time.perf_counter()
+        status, _ = self.web_get(f'{host}/identity')
+        self.trace.record('scan.probe', start, status=status)
+        return status == 200
+
+
+    def web_get_with_retry(self, url, headers={}):
+        """
+        Like web_get, but retries connection failures and server errors a few times, with
+        exponential backoff and jitter so a burst of scanners doesn't retry in lockstep
+        """
+
+        for attempt in range(self.retries + 1):
+            status, body = self.web_get(url, headers)
+            if status != None and status < 500:
+                break
+            if attempt < self.retries:
+                import random
+                time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+        return status, body
+
+
+    def web_get_json(self, url):
+        """Returns the MediaContainer of a JSON GET request, or None if the request failed"""
+        status, body = self.web_get(url, { 'Accept' : 'application/json' })
+        try:
+            return json.loads(body)['MediaContainer'] if status == 200 else None
+        except (ValueError, KeyError):
+            return None
+
+
+    def web_get(self, url, headers={}):
+        """
+        Sends a GET request and returns the status code and body, or (None, None) if the request failed.
+        Scans only make a few simple requests, so they use http.client directly and skip the cost of
+        importing requests. Connections are kept alive and reused for other requests to the same server.
+        """
+
+        import http.client
+        parts = urllib.parse.urlsplit(url)
+        connections = self.local.__dict__.setdefault('connections', {})
+        reused = parts.netloc in connections
+        while True:
+            conn = connections.get(parts.netloc)
+            try:
+                if conn == None:
+                    conn_type = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+                    conn = connections[parts.netloc] = conn_type(parts.netloc, timeout=self.timeouts[0])
+                    conn.connect()
+                    conn.sock.settimeout(self.timeouts[1])
+
+                with self.governed(url) as request:
+                    conn.request('GET', f'{parts.path}?{parts.query}', headers=headers)
+                    response = conn.getresponse()
+                    request.ok = response.status < 500
+                    return response.status, response.read()
+            except Exception as e:
+                if conn != None:
+                    conn.close()
+                connections.pop(parts.netloc, None)
+
+                # The server may have closed a kept-alive connection that sat idle for too long, which only shows
+                # once it's reused. Resend once on a new connection, but not after timeouts or on new connections
+                if reused and isinstance(e, (ConnectionError, http.client.BadStatusLine)):
+                    reused = False
+                    continue
+                return None, None
+
+
+    def governed(self, url):
+        """Returns a context manager to send a request to the given server (or any URL on it) in, see Governor"""
+        if self.governor == None:
+            return contextlib.nullcontext(Ungoverned())
+        return self.governor.request(urllib.parse.urlsplit(url).netloc)
+
+
+    def get_session(self, pool_size=1):
+        """
+        Returns the keep-alive session shared by all requests made via requests, keeping at least
+        pool_size connections to each server. Asking for more than an earlier caller did grows the
+        pool, so that requests sent from that many threads at once don't throw connections away.
+        """
+
+        import requests
+        if self.session == None:
+            self.session = requests.Session()
+        if pool_size > self.pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.pool_size = pool_size
+        return self.session
+
+
+    def find_items(self, section, mappings, directory, media_type, refresh_key):
+        """
+        Returns (id, updatedAt, [(file, size)], [ancestor ids]) for all items under the given directory, using the cheapest method that works:
+          1. Browsing the section's folders down to the directory and listing only what's inside it.
+             Skipped for library roots, since that would list the whole section one folder at a time.
+          2. Looking up the directory in the local item index.
+          3. Paging through every item in the section.
+        """
+
+        if not any(path_key(root) == path_key(directory) for root in section['paths']):
+            try:
+                candidates = self.find_folder_items(section, mappings, directory, refresh_key)
+                if candidates != None:
+                    return candidates
+            except Exception:
+                pass
+
+        try:
+            return self.find_indexed_items(section, mappings, directory, media_type, refresh_key)
+        except Exception:
+            # The index is only an optimization, so fall back to searching the section listing directly
+            return self.find_listed_items(section, mappings, directory, media_type, refresh_key)
+
+
+    def find_folder_items(self, section, mappings, directory, refresh_key):
+        """
+        Returns the items under the given directory (see find_items) by walking the section's folder
+        hierarchy (/library/sections/{id}/folder) from the matching root down to the directory,
+        then listing everything beneath it. The cost scales with the size of the directory
+        instead of the size of the library. Returns None if the folder hierarchy didn't lead
+        to any items, in which case the caller should look for them some other way.
+        """
+
+        target = RootIndex.split(directory)
+        roots = [root for root in [RootIndex.split(path) for path in section['paths']] if target[:len(root)] == root]
+        if len(roots) == 0:
+            return None
+        root = max(roots, key=len)
+
+        # The top level of the hierarchy has one folder per root. Depending on the server version
+        # these are titled with either the full path or the root's own folder name
+        top_level = self.get_folder(mappings, f'/library/sections/{section["section"]}/folder').get('Directory', [])
+        key = next((folder['key'] for folder in top_level if RootIndex.split(folder['title']) in [root, root[-1:]]), None)
+        for component in target[len(root):]:
+            if key == None:
+                return None
+            folders = self.get_folder(mappings, key).get('Directory', [])
+            key = next((folder['key'] for folder in folders if folder['title'].casefold() == component), None)
+
+        if key == None:
+            return None
+
+        candidates = []
+        remaining = [key]
+        while len(remaining) > 0:
+            container = self.get_folder(mappings, remaining.pop())
+            remaining.extend(folder['key'] for folder in container.get('Directory', []))
+            for item in container.get('Metadata', []):
+                candidate = Scanner.item_candidate(item, refresh_key)
+                if candidate != None:
+                    candidates.append(candidate)
+
+        return candidates if len(candidates) > 0 else None
+
+
+    def get_folder(self, mappings, key):
+        """Returns the MediaContainer for the given folder key, e.g. /library/sections/1/folder?parent=2"""
+        sep = '&' if '?' in key else '?'
+        start = time.perf_counter()
+        with self.governed(mappings['host']):
+            response = self.get_session().get(f'{mappings["host"]}{key}{sep}X-Plex-Token={mappings["token"]}', headers={ 'Accept' : 'application/json' }, timeout=self.timeouts)
+        try:
+            return json.loads(response.content)['MediaContainer']
         finally:
             response.close()
+            self.trace.record('refresh.folder', start, status=response.status_code, bytes=len(response.content))
+
+
+    def find_indexed_items(self, section, mappings, directory, media_type, refresh_key):
+        """
+        Returns the items under the given directory (see find_items) using the local
+        item index, bringing the index up to date with the server first
+        """
+
+        from ScanInPlexItemIndex import ItemIndex
+        index = ItemIndex(Common.app_data_file('index.db'))
+        try:
+            self.sync_index(index, section, mappings, media_type)
+            level = HIERARCHY_KEYS.index(refresh_key)
+            return [(row[level], row[5], [(row[3], row[4])], list(row[level + 1:3])) for row in index.find(Scanner.index_key(section), directory)]
+        finally:
+            index.close()
+
+
+    def sync_index(self, index, section, mappings, media_type):
+        """
+        Brings the item index for a section up to date. Items added or changed since the last
+        sync are fetched incrementally, and the section is only rebuilt from scratch if the
+        number of items no longer lines up with the server (e.g. because items were deleted).
+        If a shared snapshot is configured (snapshot_path), the section is seeded from it
+        before resorting to a rebuild, leaving only what changed since it was taken to fetch.
+        """
 
-        if not 'Metadata' in json_response:
+        section_id = section['section']
+        key = Scanner.index_key(section)
+        start = time.perf_counter()
+        if index.get_sync_state(key) != None and self.sync_from_checkpoint(index, section, mappings, media_type):
+            self.trace.record('refresh.index_sync', start, section=section_id, rebuilt=False)
             return
 
-        refreshed = set()
-        for item in json_response['Metadata']:
-            metadata_id = int(item[refresh_key])
-            if metadata_id in refreshed:
-                continue
+        if self.seed_index(index, section, mappings) and self.sync_from_checkpoint(index, section, mappings, media_type):
+            self.trace.record('refresh.index_sync', start, section=section_id, rebuilt=False, seeded=True)
+            return
+
+        index.rebuild(key, self.get_section_items(mappings['host'], mappings['token'], section_id, media_type, mappings.get('page_size', DEFAULT_PAGE_SIZE)))
+        self.trace.record('refresh.index_sync', start, section=section_id, rebuilt=True)
+
+
+    def sync_from_checkpoint(self, index, section, mappings, media_type):
+        """Adds the items changed since the section's checkpoint to the index, returning whether it now matches the server"""
+        token = mappings['token']
+        host = mappings['host']
+        key = Scanner.index_key(section)
+
+        # '>>=' is Plex's "greater than" filter. Step back a second so items updated in the same
+        # second as the checkpoint aren't missed. Indexing them a second time is harmless.
+        checkpoint = index.get_sync_state(key)[1]
+        index.update(key, self.get_section_items(host, token, section['section'], media_type, mappings.get('page_size', DEFAULT_PAGE_SIZE), f'updatedAt>>={checkpoint - 1}'), checkpoint)
+        return index.get_sync_state(key)[0] == self.get_section_count(host, token, section['section'], media_type)
+
+
+    def seed_index(self, index, section, mappings):
+        """
+        Replaces the section in the index with the contents of its shared snapshot, if there is one that's
+        newer than what the index already has. Returns whether the index was seeded
+        """
+
+        if not mappings.get('snapshot_path'):
+            return False
+
+        # Snapshots are named after the server they're from, since another machine may list the servers in a different order
+        machine = self.get_machine_identifier(mappings)
+        if machine == None:
+            return False
+
+        from ScanInPlexSnapshot import read_header, read_items, snapshot_file
+        key = Scanner.index_key(section)
+        path = snapshot_file(mappings['snapshot_path'], machine, section['section'])
+        header = read_header(path)
+        state = index.get_sync_state(key)
+        if header == None or header.get('machine') != machine or header['section'] != section['section'] or (state != None and header['checkpoint'] <= state[1]):
+            return False
+
+        start = time.perf_counter()
+        try:
+            index.rebuild(key, read_items(path), header['checkpoint'])
+        except (OSError, ValueError, EOFError):
+            return False # Incomplete or unreadable, so the section's gone from the index and will be rebuilt
+        self.trace.record('refresh.index_seed', start, section=section['section'], items=header['items'])
+        return True
+
+
+    def get_machine_identifier(self, mappings):
+        """Returns the unique id of the given server, or None if it couldn't be reached"""
+        if mappings['host'] not in self.machine_identifiers:
+            identity = self.web_get_json(f'{mappings["host"]}/identity?X-Plex-Token={mappings["token"]}')
+            if identity == None or 'machineIdentifier' not in identity:
+                return None
+            self.machine_identifiers[mappings['host']] = identity['machineIdentifier']
+        return self.machine_identifiers[mappings['host']]
+
+
+    def find_listed_items(self, section, mappings, directory, media_type, refresh_key):
+        """
+        Yields the items under the given directory (see find_items) by paging through every item
+        in the section. Items are yielded as soon as their page is processed, so refreshes can
+        start before the whole listing has been downloaded
+        """
+
+        prefix = path_key(directory) + '\\'
+        try:
+            for item in self.get_section_items(mappings['host'], mappings['token'], section['section'], media_type, mappings.get('page_size', DEFAULT_PAGE_SIZE)):
+                candidate = Scanner.item_candidate(item, refresh_key, prefix)
+                if candidate != None:
+                    yield candidate
+        except Exception:
+            return
+
+
+    def get_section_items(self, host, token, section_id, media_type, page_size, filter=''):
+        """
+        Yields all items of the given type in a section, requesting a single page of items
+        at a time so memory use is bounded by the page size and not the size of the library
+        """
+
+        start = 0
+        while True:
+            url = f'{host}/library/sections/{section_id}/all?type={media_type}&includeFields={ITEM_FIELDS}&X-Plex-Token={token}'
+            if filter:
+                url += f'&{filter}'
+            headers = {
+                'Accept' : 'application/json',
+                'X-Plex-Container-Start' : str(start),
+                'X-Plex-Container-Size' : str(page_size)
+            }
+            page_start = time.perf_counter()
+            with self.governed(host):
+                response = self.get_session().get(url, headers=headers, timeout=self.timeouts)
+            try:
+                container = json.loads(response.content)['MediaContainer']
+            finally:
+                response.close()
+
+            items = container.get('Metadata', [])
+            self.trace.record('refresh.list', page_start, section=section_id, offset=start, items=len(items), bytes=len(response.content))
+            yield from items
+
+            start += len(items)
+            if len(items) < page_size or start >= int(container.get('totalSize', start)):
+                return
+
+
+    def get_section_count(self, host, token, section_id, media_type):
+        """Returns the number of items of the given type in a section without listing any of them"""
+        url = f'{host}/library/sections/{section_id}/all?type={media_type}&X-Plex-Token={token}'
+        headers = { 'Accept' : 'application/json', 'X-Plex-Container-Start' : '0', 'X-Plex-Container-Size' : '0' }
+        start = time.perf_counter()
+        with self.governed(host):
+            response = self.get_session().get(url, headers=headers, timeout=self.timeouts)
+        try:
+            return int(json.loads(response.content)['MediaContainer']['totalSize'])
+        finally:
+            response.close()
+            self.trace.record('refresh.count', start, section=section_id, status=response.status_code)
+
+
+class ConfigFile:
+    """
+    config.json and its section root index, as seen by a long-running process (--serve, --notifications).
+    Reloaded whenever the file changes on disk, e.g. after reconfiguring or when any scanner finds that
+    the libraries changed. Scanners pick up changed request settings when given the reloaded config.
+    """
+
+    def __init__(self):
+        self.mappings = None
+        self.index = None
+        self.mtime = None
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        """(Re)loads config.json if it changed since it was last loaded. Returns whether there's a config"""
+        with self.lock:
+            try:
+                mtime = os.stat(Common.app_data_file('config.json')).st_mtime_ns
+            except OSError:
+                return self.mappings != None
+
+            if mtime != self.mtime:
+                mappings, index = Scanner.load_config()
+                if mappings != None:
+                    self.mappings, self.index = mappings, index
+                    self.mtime = mtime
+            return self.mappings != None
+
+
+    def update(self, mappings, index):
+        """Switches to the config update_sections just wrote"""
+        with self.lock:
+            self.mappings, self.index = mappings, index
+
 
-            for version in item['Media']:
-                for part in version['Part']:
-                    if part['file'].lower().startswith(self.dir.lower()):
-                        refreshed.add(int(metadata_id))
-                        requests.put(f'{host}/library/metadata/{metadata_id}/refresh?X-Plex-Token={token}')
+class Ungoverned:
+    """Stand-in for GovernedRequest when there's no governor"""
+    ok = True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,247 @@
+import collections
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+from ScanInPlexIndex import path_key
+from ScanInPlexScanner import DEFAULT_BROKER_MAX_WAIT, DEFAULT_BROKER_WINDOW, DEFAULT_SECTIONS_RETRY, ConfigFile, Scanner
+
+# How far back the recent throughput reported by /status looks
+THROUGHPUT_WINDOW = 300
+
+class Service:
+    """
+    A long-running scanner that accepts scan and refresh requests over HTTP (on a local port or
+    a Unix socket) instead of from the context menu, e.g. from download automation that would
+    otherwise scan whole libraries. The config, the root index, and connections to the server
+    are kept warm between requests, and requests are queued and sent in batches using the same
+    quiet period as the context menu broker, so a burst of requests is coalesced.
+
+    Endpoints:
+      POST /scan     Queue a scan. The body is { "path" : "..." } or { "paths" : [...] },
+                     or the path can be given as a query parameter (?path=...)
+      POST /refresh  Queue a metadata refresh, in the same format
+      GET  /status   Queue depth and throughput
+    """
+
+    def __init__(self, cmd_args):
+        self.cmd_args = cmd_args
+        self.listen = cmd_args.listen
+        self.socket_path = cmd_args.socket
+        self.quiet = cmd_args.quiet
+        self.scanner = Scanner(cmd_args)
+        self.intake = Scanner(cmd_args) # For checking for new library folders without getting in the scanner's way
+        self.config = ConfigFile()
+
+        self.lock = threading.Condition()
+        self.intake_lock = threading.Lock()
+        self.pending = {}
+        self.first_pending = None
+        self.last_pending = None
+        self.in_flight = 0
+        self.stats = { 'received' : 0, 'coalesced' : 0, 'unmatched' : 0, 'processed' : 0, 'batches' : 0 }
+        self.completed = collections.deque()
+        self.last_batch_seconds = None
+        self.started = time.time()
+        self.stopping = False
+
+
+    def serve(self):
+        if not self.config.load():
+            print('Could not find config.json. Have you run configuration (-c)?')
+            return
+
+        if self.socket_path:
+            if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+                print('Unix sockets aren\'t supported on this platform. Use --listen instead.')
+                return
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            server = UnixHTTPServer(self.socket_path, self.handler())
+            address = self.socket_path
+        else:
+            host, _, port = self.listen.rpartition(':')
+            server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), self.handler())
+            address = f'http://{server.server_address[0]}:{server.server_address[1]}'
+
+        worker = threading.Thread(target=self.work, daemon=True)
+        worker.start()
+        self.log(f'Accepting scan requests on {address}. Press Ctrl+C to stop.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            with self.lock:
+                self.stopping = True
+                self.lock.notify()
+            worker.join()
+            if self.socket_path and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+    def handler(self):
+        current = self
+        class Handler(ServiceHandler):
+            service = current
+        return Handler
+
+
+    def enqueue(self, paths, refresh):
+        """Queues the given paths, returning the ones that aren't in any library"""
+        self.config.load()
+        unmatched = [path for path in paths if self.config.index.lookup(path) == None]
+        if len(unmatched) > 0:
+            with self.intake_lock: # Only one request at a time needs to check
+                mappings = self.config.mappings
+                updated = self.intake.update_sections(mappings, mappings.get('sections_retry', DEFAULT_SECTIONS_RETRY))
+                if updated != None:
+                    self.config.update(*updated)
+            unmatched = [path for path in unmatched if self.config.index.lookup(path) == None]
+
+        with self.lock:
+            self.stats['received'] += len(paths)
+            self.stats['unmatched'] += len(unmatched)
+            for path in paths:
+                if path in unmatched:
+                    continue
+
+                key = (path_key(path), refresh)
+                if key in self.pending:
+                    self.stats['coalesced'] += 1
+                    continue
+                self.pending[key] = { 'directory' : path, 'refresh' : refresh }
+                now = time.monotonic()
+                self.first_pending = self.first_pending or now
+                self.last_pending = now
+            self.lock.notify()
+        return unmatched
+
+
+    def work(self):
+        """Sends queued requests once they've stopped coming in for a moment, or have waited long enough"""
+        while True:
+            with self.lock:
+                while True:
+                    if self.stopping:
+                        return
+                    if len(self.pending) > 0:
+                        window = self.config.mappings.get('broker_window', DEFAULT_BROKER_WINDOW)
+                        max_wait = self.config.mappings.get('broker_max_wait', DEFAULT_BROKER_MAX_WAIT)
+                        now = time.monotonic()
+                        remaining = min(self.last_pending + window, self.first_pending + max_wait) - now
+                        if remaining <= 0:
+                            break
+                        self.lock.wait(remaining)
+                    else:
+                        self.lock.wait()
+
+                batch = list(self.pending.values())
+                self.pending = {}
+                self.first_pending = None
+                self.in_flight = len(batch)
+
+            start = time.monotonic()
+            try:
+                self.config.load() # process_batch re-applies any request settings that changed
+                self.scanner.process_batch(batch, self.config.mappings, self.config.index)
+            except Exception as e:
+                self.log(f'Error processing batch: {e}')
+
+            with self.lock:
+                self.in_flight = 0
+                self.stats['processed'] += len(batch)
+                self.stats['batches'] += 1
+                self.last_batch_seconds = time.monotonic() - start
+                now = time.time()
+                self.completed.extend([now] * len(batch))
+                while len(self.completed) > 0 and self.completed[0] < now - THROUGHPUT_WINDOW:
+                    self.completed.popleft()
+            self.log(f'Processed {len(batch)} request(s) in {self.last_batch_seconds:.2f} seconds')
+
+
+    def status(self):
+        with self.lock:
+            now = time.time()
+            uptime = now - self.started
+            recent = sum(1 for completed in self.completed if completed >= now - THROUGHPUT_WINDOW)
+            return dict(self.stats,
+                queue_depth=len(self.pending),
+                in_flight=self.in_flight,
+                uptime_seconds=round(uptime, 1),
+                per_minute=round(self.stats['processed'] / max(uptime, 1) * 60, 2),
+                recent_per_minute=round(recent / min(max(uptime, 1), THROUGHPUT_WINDOW) * 60, 2),
+                last_batch_seconds=round(self.last_batch_seconds, 3) if self.last_batch_seconds != None else None)
+
+
+    def log(self, message):
+        if not self.quiet:
+            print(message, flush=True)
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    service = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == '/status':
+            return self.reply(200, self.service.status())
+        self.reply(404, { 'error' : 'Not found' })
+
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path not in ['/scan', '/refresh']:
+            return self.reply(404, { 'error' : 'Not found' })
+
+        paths = urllib.parse.parse_qs(url.query).get('path', [])
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                return self.reply(400, { 'error' : 'Invalid JSON' })
+            if not isinstance(body, dict) or not isinstance(body.get('paths', []), list):
+                return self.reply(400, { 'error' : 'Expected an object with "path" and/or a "paths" list' })
+            paths.extend(body.get('paths', []))
+            if 'path' in body:
+                paths.append(body['path'])
+
+        if any(not isinstance(path, str) for path in paths):
+            return self.reply(400, { 'error' : 'Paths must be strings' })
+        if len(paths) == 0:
+            return self.reply(400, { 'error' : 'No path given' })
+
+        unmatched = self.service.enqueue(paths, url.path == '/refresh')
+        self.reply(202 if len(unmatched) < len(paths) else 404, { 'queued' : len(paths) - len(unmatched), 'unmatched' : unmatched })
+
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'): # Not on Windows
+    class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+        """An HTTP server listening on a Unix socket instead of a port"""
+        daemon_threads = True
+
+        def get_request(self):
+            request, _ = super().get_request()
+            return request, ('unix', 0)
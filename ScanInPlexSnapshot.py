@@ -0,0 +1,164 @@
+import gzip
+import itertools
+import json
+import os
+import time
+import ScanInPlexCommon as Common
+
+# Bump whenever the format changes. Snapshots in any other format are ignored
+SNAPSHOT_VERSION = 2
+
+SNAPSHOT_FORMAT = 'ScanInPlex snapshot'
+
+# What each item line holds, in order
+SNAPSHOT_FIELDS = ['ratingKey', 'parentRatingKey', 'grandparentRatingKey', 'updatedAt', 'parts']
+
+def snapshot_file(path, machine, section_id):
+    """
+    Returns the snapshot file of the given section of the server with the given machineIdentifier in the given
+    snapshot folder. Servers are named by their identity rather than their position in the servers list, since
+    every machine may list them in a different order.
+    """
+    return os.path.join(path, f'{machine}-section-{section_id}.ndjson.gz')
+
+
+def write_snapshot(path, header, rows):
+    """
+    Writes a section's snapshot, given its header and the (ratingKey, parentRatingKey, grandparentRatingKey,
+    updatedAt, file, size) of every file in it, sorted by ratingKey. The first line of the file is the header,
+    followed by one compact JSON array per item. The file is replaced all at once, so scanners reading it at
+    the same time see either the old snapshot or the new one.
+    """
+
+    temp = f'{path}.{os.getpid()}.tmp'
+    count = 0
+    try:
+        with gzip.open(temp, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+            for rating_key, files in itertools.groupby(rows, key=lambda row: row[0]):
+                files = list(files)
+                _, parent_key, grandparent_key, updated_at, _, _ = files[0]
+                f.write(json.dumps([rating_key, parent_key, grandparent_key, updated_at, [[row[4], row[5]] for row in files]], separators=(',', ':')) + '\n')
+                count += 1
+        if count != header['items']:
+            raise ValueError(f'Expected {header["items"]} items, found {count}')
+        os.replace(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def read_header(path):
+    """Returns the header of the given snapshot, or None if it doesn't exist or is in a format we don't understand"""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+    except (OSError, ValueError, EOFError):
+        return None
+    if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+        return None
+    return header
+
+
+def read_items(path):
+    """
+    Yields the items in the given snapshot, in the same form as a section listing, streaming them
+    from the file so memory use doesn't depend on the size of the section. Raises ValueError once
+    the end is reached if the snapshot didn't have as many items as its header says it should.
+    """
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        count = 0
+        for line in f:
+            rating_key, parent_key, grandparent_key, updated_at, parts = json.loads(line)
+            item = { 'ratingKey' : rating_key, 'Media' : [{ 'Part' : [{ 'file' : file, 'size' : size } for file, size in parts] }] }
+            if parent_key != None:
+                item['parentRatingKey'] = parent_key
+            if grandparent_key != None:
+                item['grandparentRatingKey'] = grandparent_key
+            if updated_at != None:
+                item['updatedAt'] = updated_at
+            count += 1
+            yield item
+
+    if count != header['items']:
+        raise ValueError(f'Snapshot is incomplete. Expected {header["items"]} items, found {count}')
+
+
+class Exporter:
+    """
+    Writes a snapshot of every library section's items (their files and ratingKeys) to a shared folder,
+    so that scanners on other machines can seed their item index from it (see snapshot_path) and only
+    ask the server for what changed since, instead of each of them listing every section in full.
+    Each section is written to its own gzipped file of newline-delimited JSON, starting with a header
+    recording the section, the server it's on (its machineIdentifier), its item count, and the checkpoint
+    (newest updatedAt) it's current as of.
+    The snapshot is built from this machine's own item index, which is brought up to date first.
+    """
+
+    def __init__(self, cmd_args):
+        self.cmd_args = cmd_args
+        self.output = cmd_args.export
+        self.quiet = cmd_args.quiet
+
+
+    def export(self):
+        from ScanInPlexItemIndex import ItemIndex
+        from ScanInPlexScanner import Scanner
+        mappings, _ = Scanner.load_config()
+        if mappings == None:
+            print('Could not find config.json. Have you run configuration (-c)?')
+            return
+        if len(Scanner.get_servers(mappings)) == 0:
+            print('Exporting requires the web API. Rerun configuration (-c) without --noweb.')
+            return
+
+        os.makedirs(self.output, exist_ok=True)
+        scanner = Scanner(self.cmd_args)
+        scanner.use_config(mappings)
+        index = ItemIndex(Common.app_data_file('index.db'))
+        try:
+            for section in mappings['sections']:
+                if section['type'] not in ['movie', 'show', 'artist']:
+                    continue
+
+                key = Scanner.index_key(section)
+                media_type, _ = Scanner.item_type(section)
+                server = Scanner.server_mappings(mappings, section)
+                machine = scanner.get_machine_identifier(server)
+                if machine == None:
+                    print(f'Could not reach {server["host"]}. Skipping section {section["section"]}')
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    scanner.sync_index(index, section, server, media_type)
+                except Exception as e:
+                    print(f'Could not list section {section["section"]}: {e}')
+                    continue
+
+                item_count, checkpoint = index.get_sync_state(key)
+                header = {
+                    'format' : SNAPSHOT_FORMAT,
+                    'version' : SNAPSHOT_VERSION,
+                    'section' : section['section'],
+                    'server' : section.get('server', 0),
+                    'machine' : machine,
+                    'type' : section['type'],
+                    'items' : item_count,
+                    'checkpoint' : checkpoint,
+                    'created' : int(time.time()),
+                    'fields' : SNAPSHOT_FIELDS,
+                }
+                path = snapshot_file(self.output, machine, section['section'])
+                write_snapshot(path, header, index.rows(key))
+                self.log(f'Section {section["section"]}: {item_count} items in {time.perf_counter() - start:.1f} seconds ({os.path.getsize(path) / 1024:.0f} KiB)')
+        finally:
+            index.close()
+
+
+    def log(self, message):
+        if not self.quiet:
+            print(message)
@@ -0,0 +1,77 @@
+import json
+import math
+import os
+import threading
+import time
+
+DEFAULT_MAX_KB = 1024
+
+class Trace:
+    """
+    Opt-in log of how long each phase of a scan or refresh took, written as one JSON object
+    per line. The scanner runs without a window and fails silently, so this is the only way
+    to see what it actually did. Once the log grows past its size cap it's moved aside to
+    a single backup (.1) and a new log is started.
+    """
+
+    def __init__(self, path=None, max_kb=DEFAULT_MAX_KB):
+        self.path = path
+        self.enabled = path != None
+        self.max_bytes = max_kb * 1024
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def for_config(mappings, path):
+        """Returns a trace that writes to path if tracing is enabled in the given config, and does nothing otherwise"""
+        if not mappings.get('trace', False):
+            return Trace()
+        return Trace(path, mappings.get('trace_max_kb', DEFAULT_MAX_KB))
+
+
+    def record(self, phase, start, **details):
+        """Records a phase that began at start (a time.perf_counter() value), along with any extra details"""
+        if not self.enabled:
+            return
+
+        entry = { 'time' : round(time.time(), 3), 'pid' : os.getpid(), 'phase' : phase, 'ms' : round((time.perf_counter() - start) * 1000, 2) }
+        entry.update(details)
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    os.replace(self.path, self.path + '.1')
+            except OSError:
+                pass # Probably another scanner rotating it at the same time
+
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(line)
+            except OSError:
+                pass
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def summarize(path):
+    """Returns { phase : (count, p50, p95) } for every phase recorded in the given log and its backup"""
+    durations = {}
+    for log in [path + '.1', path]:
+        if not os.path.exists(log):
+            continue
+        with open(log, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    durations.setdefault(entry['phase'], []).append(float(entry['ms']))
+                except (ValueError, KeyError):
+                    continue # Partially written line
+
+    summary = {}
+    for phase, values in durations.items():
+        values.sort()
+        summary[phase] = (len(values), percentile(values, 50), percentile(values, 95))
+    return summary
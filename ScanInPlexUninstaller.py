@@ -1,6 +1,7 @@
 import argparse
 import os
 import ScanInPlexCommon as Common
+import ScanInPlexRegistry as Registry
 import shutil
 import traceback
 
@@ -31,34 +32,15 @@ class Uninstall:
                     shutil.rmtree(config_path)
                 except:
                     errors = True
-        if self.is_admin:
-            os.system('REG DELETE HKCR\\Directory\\shell\\ScanInPlex /f >NUL')
-            os.system('REG DELETE HKCR\\Directory\\shell\\RefreshInPlex /f >NUL')
-        else:
-            errors = errors or not self.uninstall_via_file()
-
-        if not self.cmd_args.quiet:
-            print('Uninstall complete' + (' with errors' if errors else ''))
-
-
-    def uninstall_via_file(self):
-        text  = f'Windows Registry Editor Version 5.00\n\n'
-
-        text += f'[-HKEY_CLASSES_ROOT\\Directory\\shell\\ScanInPlex]\n'
-        text += f'[-HKEY_CLASSES_ROOT\\Directory\\shell\\RefreshInPlex]\n'
-
-        reg_temp = '_uninstall.tmp.reg'
         try:
-            with open(reg_temp, 'w') as reg:
-                reg.writelines([text])
-        except Exception:
+            Registry.get_backend(self.is_admin).apply({ key : None for key in Registry.MENU_KEYS })
+        except OSError:
             print('\nError removing registry entries:')
             traceback.print_exc()
-            return False
+            errors = True
 
-        os.system(f'.\\{reg_temp}')
-        os.remove(reg_temp)
-        return True
+        if not self.cmd_args.quiet:
+            print('Uninstall complete' + (' with errors' if errors else ''))
 
 
 if __name__ == '__main__':
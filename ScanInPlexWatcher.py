@@ -0,0 +1,169 @@
+import os
+import queue
+import time
+from ScanInPlexIndex import RootIndex, path_key
+from ScanInPlexScanner import Scanner
+
+try:
+    # Optional. Uses the OS's change notifications instead of polling if available
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+class PollingBackend:
+    """
+    Detects changes by periodically walking every library root and comparing folder modification
+    times. Adding, removing, or renaming anything in a folder updates its modification time, so
+    only the folders themselves need to be checked, not the files in them.
+    """
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.snapshot = self.take_snapshot()
+
+
+    def take_snapshot(self):
+        snapshot = {}
+        remaining = list(self.roots)
+        while len(remaining) > 0:
+            folder = remaining.pop()
+            try:
+                snapshot[folder] = os.stat(folder).st_mtime_ns
+                with os.scandir(folder) as entries:
+                    remaining.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+        return snapshot
+
+
+    def changes(self):
+        """Returns the set of folders that changed since the last call"""
+        snapshot = self.take_snapshot()
+        changed = set(folder for folder, mtime in snapshot.items() if self.snapshot.get(folder) != mtime)
+
+        # A deleted folder shows up as a change to its parent (if it still exists)
+        changed.update(os.path.dirname(folder) for folder in self.snapshot if folder not in snapshot)
+        self.snapshot = snapshot
+        return changed
+
+
+class NotificationBackend:
+    """Collects changes reported by the OS via watchdog"""
+
+    def __init__(self, roots):
+        self.events = queue.Queue()
+        self.observer = Observer()
+        handler = FileSystemEventHandler()
+        handler.on_any_event = self.on_event
+        for root in roots:
+            self.observer.schedule(handler, root, recursive=True)
+        self.observer.start()
+
+
+    def on_event(self, event):
+        # The deepest folder affected by a change is the one holding whatever changed
+        self.events.put(os.path.dirname(event.src_path))
+        if getattr(event, 'dest_path', None):
+            self.events.put(os.path.dirname(event.dest_path))
+
+
+    def changes(self):
+        changed = set()
+        while not self.events.empty():
+            changed.add(self.events.get())
+        return changed
+
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+class Watcher:
+    """
+    Watches every library root for changes and scans the folders that changed once things
+    have settled down, for those who want new files picked up without Plex's own automatic
+    scanning (or having to click anything).
+    """
+
+    def __init__(self, cmd_args):
+        self.cmd_args = cmd_args
+        self.settle = cmd_args.settle
+        self.poll = cmd_args.poll
+        self.max_scans = cmd_args.max_scans
+        self.quiet = cmd_args.quiet
+
+
+    def watch(self):
+        mappings, index = Scanner.load_config()
+        if mappings == None:
+            print('Could not find config.json. Have you run configuration (-c)?')
+            return
+
+        roots = [path for section in mappings['sections'] for path in section['paths'] if os.path.exists(path)]
+        if len(roots) == 0:
+            print('None of your library folders are accessible from this machine.')
+            return
+
+        if Observer != None:
+            backend = NotificationBackend(roots)
+            interval = 1
+        else:
+            backend = PollingBackend(roots)
+            interval = self.poll
+
+        scanner = Scanner(self.cmd_args)
+        self.log(f'Watching {len(roots)} folders for changes. Press Ctrl+C to stop.')
+        pending = set()
+        last_change = 0
+        last_scan = 0
+        try:
+            while True:
+                time.sleep(interval)
+                changed = set(folder for folder in backend.changes() if index.lookup(folder) != None)
+                if len(changed) > 0:
+                    pending.update(changed)
+                    last_change = time.monotonic()
+
+                # Wait for things to settle so a large copy results in a single batch of scans,
+                # and never scan more often than once per settle period
+                now = time.monotonic()
+                if len(pending) > 0 and now - last_change >= self.settle and now - last_scan >= self.settle:
+                    folders = self.limit(pending, mappings, index)
+                    self.log(f'Scanning {len(folders)} folder(s)')
+                    for folder in folders:
+                        self.log(f'  {folder}')
+                    scanner.process_batch([{ 'directory' : folder, 'refresh' : False } for folder in folders], mappings, index)
+                    pending = set()
+                    last_scan = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if isinstance(backend, NotificationBackend):
+                backend.stop()
+
+
+    def limit(self, folders, mappings, index):
+        """
+        Returns the folders to scan for the given changed folders. Folders under another changed folder
+        are covered by that folder's scan, and if there are still more than the limit, the deepest
+        folders are replaced by their parents until there aren't, without going above a library root.
+        """
+
+        folders = list(Scanner.without_descendants({ path_key(folder) : folder for folder in folders }).values())
+        while len(folders) > self.max_scans:
+            collapsible = [folder for folder in folders if index.lookup(os.path.dirname(folder)) == index.lookup(folder)]
+            if len(collapsible) == 0:
+                break # Everything is already a library root
+
+            deepest = max(len(RootIndex.split(folder)) for folder in collapsible)
+            collapsed = [os.path.dirname(folder) if folder in collapsible and len(RootIndex.split(folder)) == deepest else folder for folder in folders]
+            folders = list(Scanner.without_descendants({ path_key(folder) : folder for folder in collapsed }).values())
+
+        return folders
+
+
+    def log(self, message):
+        if not self.quiet:
+            print(message)
@@ -0,0 +1,438 @@
+"""
+A stand-in for Plex Media Server that serves synthetic movie, show, and music libraries of
+any size, so the scanner can be measured without a real server (or real media).
+
+Only the endpoints ScanInPlex uses are implemented, and only as far as ScanInPlex needs them.
+Every response can be delayed by a fixed latency, and a fraction of them can be failed on
+purpose to exercise error handling. The notifications websocket is also available, sending
+whatever is passed to FakePlex.notify, e.g. by add_item and remove_item.
+
+Run it standalone with e.g. `python benchmarks/fake_pms.py --movies 100000 --port 32400`,
+or use FakePlex from another script (see benchmarks/scale.py).
+"""
+
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import queue
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+
+# The first synthetic item was last updated at this time, and every later one a second after the one before it
+UPDATED_AT = 1600000000
+
+# Plex's numeric type of each leaf type, as used in timeline notifications
+TYPE_IDS = { 'movie' : 1, 'episode' : 4, 'track' : 10 }
+
+# The parent and grandparent types of each leaf type that has them
+PARENT_TYPES = { 'episode' : ('season', 'show'), 'track' : ('album', 'artist') }
+
+class Library:
+    """
+    A synthetic library section. Items are computed from their position on demand, so even
+    very large libraries take no time to create and little memory to serve.
+
+    Leaf items (movies, episodes, tracks) are grouped into parents and grandparents according
+    to shape, e.g. (10, 5) for shows is 10 episodes per season and 5 seasons per show.
+    """
+
+    def __init__(self, key, section_type, leaf_type, root, count, shape=None):
+        self.key = key
+        self.type = section_type
+        self.leaf_type = leaf_type
+        self.root = root
+        self.count = count
+        self.shape = shape
+        self.key_base = int(key) * 10000000
+        self.folders = None
+
+
+    def item(self, i):
+        rating_key = self.key_base + i
+        item = { 'ratingKey' : str(rating_key), 'type' : self.leaf_type, 'updatedAt' : UPDATED_AT + i }
+        if self.shape == None:
+            path = f'{self.root}\\Item {i:07d}\\Item {i:07d}.mkv'
+        else:
+            per_parent, per_grandparent = self.shape
+            parent = i // per_parent
+            grandparent = parent // per_grandparent
+            item['parentRatingKey'] = str(self.key_base + 8000000 + parent)
+            item['grandparentRatingKey'] = str(self.key_base + 9000000 + grandparent)
+            path = f'{self.root}\\Group {grandparent:06d}\\Subgroup {parent % per_grandparent:02d}\\Item {i:07d}.mkv'
+
+        item['Media'] = [{ 'Part' : [{ 'file' : path, 'size' : 1000000 + i }] }]
+        return item
+
+
+    def metadata(self, rating_key):
+        """Returns the item, parent, or grandparent with the given key, or None if there isn't one"""
+        offset = rating_key - self.key_base
+        if offset < 0 or offset >= 10000000:
+            return None
+        if offset < 8000000:
+            return self.item(offset) if offset < self.count else None
+        if self.shape == None:
+            return None
+
+        # Parents and grandparents hold consecutive runs of leaves and parents
+        per_parent, per_grandparent = self.shape
+        parent_type, grandparent_type = PARENT_TYPES[self.leaf_type]
+        parents = (self.count + per_parent - 1) // per_parent
+        if offset < 9000000:
+            parent = offset - 8000000
+            leaves = min(self.count, (parent + 1) * per_parent) - parent * per_parent
+            if leaves <= 0:
+                return None
+            return { 'ratingKey' : str(rating_key), 'type' : parent_type, 'leafCount' : leaves,
+                'parentRatingKey' : str(self.key_base + 9000000 + parent // per_grandparent), 'updatedAt' : UPDATED_AT }
+
+        grandparent = offset - 9000000
+        children = min(parents, (grandparent + 1) * per_grandparent) - grandparent * per_grandparent
+        if children <= 0:
+            return None
+        leaves = min(self.count, (grandparent + 1) * per_grandparent * per_parent) - grandparent * per_grandparent * per_parent
+        return { 'ratingKey' : str(rating_key), 'type' : grandparent_type, 'leafCount' : leaves, 'childCount' : children, 'updatedAt' : UPDATED_AT }
+
+
+    def section(self):
+        return { 'key' : self.key, 'type' : self.type, 'title' : f'{self.type.capitalize()} {self.key}', 'refreshing' : False, 'Location' : [{ 'path' : self.root }] }
+
+
+    def folder(self, parent):
+        """Returns (subfolders, items) for the given folder id, building the folder tree on first use"""
+        if self.folders == None:
+            self.build_folders()
+        return self.folders.get(parent, ([], []))
+
+
+    def build_folders(self):
+        # Folder ids are assigned in the order folders are first seen. 0 is the list of roots
+        self.folders = { 0 : ([(self.root, 1)], []) }
+        ids = { self.root : 1 }
+        for i in range(self.count):
+            path = self.item(i)['Media'][0]['Part'][0]['file']
+            folder = path[:path.rfind('\\')]
+            if folder not in ids:
+                parent = self.root
+                for component in folder[len(self.root) + 1:].split('\\'):
+                    child = f'{parent}\\{component}'
+                    if child not in ids:
+                        ids[child] = len(ids) + 1
+                        self.folders.setdefault(ids[parent], ([], []))[0].append((component, ids[child]))
+                    parent = child
+            self.folders.setdefault(ids[folder], ([], []))[1].append(i)
+
+
+class FakePlex:
+    def __init__(self, movies=0, episodes=0, tracks=0, latency=0, error_rate=0, seed=0):
+        self.libraries = {}
+        if movies > 0:
+            self.add(Library('1', 'movie', 'movie', 'D:\\Movies', movies))
+        if episodes > 0:
+            self.add(Library('2', 'show', 'episode', 'D:\\TV', episodes, (10, 5)))
+        if tracks > 0:
+            self.add(Library('3', 'artist', 'track', 'D:\\Music', tracks, (12, 4)))
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.refuse_forced = False # Reject forced section refreshes, like servers that don't support them
+        self.machine_identifier = 'fake-pms'
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.server = None
+        self.listeners = [] # A queue of messages for each connected notifications websocket
+
+
+    def add(self, library):
+        self.libraries[library.key] = library
+
+
+    def notify(self, container):
+        """Sends a notification to every connected websocket"""
+        with self.lock:
+            for listener in self.listeners:
+                listener.put({ 'NotificationContainer' : container })
+
+
+    def disconnect(self):
+        """Drops every notifications websocket, as a restarting server would"""
+        with self.lock:
+            for listener in self.listeners:
+                listener.put(None)
+
+
+    def add_item(self, key):
+        """Adds an item to the end of a library, announcing it like Plex does once it's been processed"""
+        library = self.libraries[key]
+        library.count += 1
+        library.folders = None
+        rating_key = library.key_base + library.count - 1
+        self.notify_timeline(library, rating_key, 5)
+        return rating_key
+
+
+    def remove_item(self, key):
+        """Removes the last item of a library"""
+        library = self.libraries[key]
+        library.count -= 1
+        library.folders = None
+        rating_key = library.key_base + library.count
+        self.notify_timeline(library, rating_key, 9)
+        return rating_key
+
+
+    def notify_timeline(self, library, rating_key, state):
+        self.notify({ 'type' : 'timeline', 'size' : 1, 'TimelineEntry' : [{
+            'identifier' : 'com.plexapp.plugins.library',
+            'sectionID' : library.key,
+            'itemID' : str(rating_key),
+            'type' : TYPE_IDS[library.leaf_type],
+            'state' : state,
+            'updatedAt' : UPDATED_AT + rating_key - library.key_base }] })
+
+
+    def reset_stats(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.scans = []
+        self.refreshes = []
+        self.in_flight = 0
+        self.peak_in_flight = 0 # The most requests being handled at the same time
+
+
+    def start(self, port=0):
+        """Starts serving on a background thread, returning the host to point the scanner at"""
+        fake = self
+        class Handler(FakePlexHandler):
+            plex = fake
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+
+    def stop(self):
+        self.disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakePlexHandler(http.server.BaseHTTPRequestHandler):
+    plex = None
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real thing
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+    def handle_request(self, method):
+        plex = self.plex
+        with plex.lock:
+            plex.requests += 1
+            plex.in_flight += 1
+            plex.peak_in_flight = max(plex.peak_in_flight, plex.in_flight)
+            fail = plex.error_rate > 0 and plex.random.random() < plex.error_rate
+        self.finished = False
+        try:
+            self.route(method, fail)
+        finally:
+            self.finish_request()
+
+
+    def finish_request(self):
+        # Called before the response goes out, since the client may send its next request as soon as it has it
+        if not self.finished:
+            self.finished = True
+            with self.plex.lock:
+                self.plex.in_flight -= 1
+
+
+    def route(self, method, fail):
+        plex = self.plex
+        if plex.latency > 0:
+            time.sleep(plex.latency)
+        if fail:
+            return self.reply(500, { 'error' : 'Injected failure' })
+
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if query.get('X-Plex-Token') == None and url.path != '/identity':
+            return self.reply(401, { 'error' : 'Unauthorized' })
+
+        for pattern, handler in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if match != None and handler.__name__.startswith(method.lower()):
+                return handler(self, query, *match.groups())
+
+        self.reply(404, { 'error' : 'Not found' })
+
+
+    def get_identity(self, query):
+        self.reply(200, { 'MediaContainer' : { 'machineIdentifier' : self.plex.machine_identifier, 'version' : '1.0.0' } })
+
+
+    def get_notifications(self, query):
+        """Upgrades to a websocket and sends notifications until told to disconnect"""
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.finish_request() # Open websockets aren't requests in flight
+        self.end_headers()
+        self.close_connection = True
+
+        messages = queue.Queue()
+        with self.plex.lock:
+            self.plex.listeners.append(messages)
+        try:
+            while True:
+                message = messages.get()
+                if message == None:
+                    self.wfile.write(b'\x88\x00') # Close
+                    return
+                data = json.dumps(message).encode('utf-8')
+                if len(data) < 126:
+                    header = struct.pack('!BB', 0x81, len(data))
+                elif len(data) < 65536:
+                    header = struct.pack('!BBH', 0x81, 126, len(data))
+                else:
+                    header = struct.pack('!BBQ', 0x81, 127, len(data))
+                self.wfile.write(header + data)
+        except OSError:
+            pass # The client went away
+        finally:
+            with self.plex.lock:
+                self.plex.listeners.remove(messages)
+
+
+    def get_items(self, query, rating_keys):
+        """Any number of items (or parents and grandparents), as a comma-separated list of keys"""
+        items = []
+        for rating_key in [int(rating_key) for rating_key in rating_keys.split(',')]:
+            library = self.plex.libraries.get(str(rating_key // 10000000))
+            item = library.metadata(rating_key) if library != None else None
+            if item != None:
+                items.append(item)
+        if len(items) == 0:
+            return self.reply(404, None)
+        self.reply(200, { 'MediaContainer' : { 'size' : len(items), 'Metadata' : items } })
+
+
+    def get_activities(self, query):
+        self.reply(200, { 'MediaContainer' : { 'size' : 0 } })
+
+
+    def get_sections(self, query):
+        sections = [library.section() for library in self.plex.libraries.values()]
+        self.reply(200, { 'MediaContainer' : { 'size' : len(sections), 'Directory' : sections } })
+
+
+    def get_section_scan(self, query, key):
+        if query.get('force') and self.plex.refuse_forced:
+            return self.reply(400, None)
+        with self.plex.lock:
+            self.plex.scans.append((key, query.get('path'), query.get('force')))
+        self.reply(200, None)
+
+
+    def get_all(self, query, key):
+        library = self.plex.libraries.get(key)
+        if library == None:
+            return self.reply(404, None)
+
+        # Later items were updated later, so an updatedAt filter ("updatedAt>>=X", i.e. greater than X) skips the earliest ones
+        first = 0
+        for name, value in query.items():
+            if name.startswith('updatedAt>>'):
+                first = max(first, min(library.count, int(value) - UPDATED_AT + 1))
+        total = library.count - first
+
+        start = int(self.headers.get('X-Plex-Container-Start', query.get('X-Plex-Container-Start', 0)))
+        size = int(self.headers.get('X-Plex-Container-Size', query.get('X-Plex-Container-Size', total)))
+        items = [library.item(first + i) for i in range(start, min(total, start + size))]
+        self.reply(200, { 'MediaContainer' : { 'size' : len(items), 'totalSize' : total, 'offset' : start, 'Metadata' : items } })
+
+
+    def get_folder(self, query, key):
+        library = self.plex.libraries.get(key)
+        if library == None:
+            return self.reply(404, None)
+
+        folders, items = library.folder(int(query.get('parent', 0)))
+        container = {
+            'size' : len(folders) + len(items),
+            'Directory' : [{ 'key' : f'/library/sections/{key}/folder?parent={folder_id}', 'title' : title } for title, folder_id in folders],
+            'Metadata' : [library.item(i) for i in items],
+        }
+        self.reply(200, { 'MediaContainer' : container })
+
+
+    def put_item_refresh(self, query, rating_key):
+        with self.plex.lock:
+            self.plex.refreshes.append(rating_key)
+        self.reply(200, None)
+
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8') if body != None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.finish_request()
+        self.end_headers()
+        self.wfile.write(data)
+        with self.plex.lock:
+            self.plex.bytes_sent += len(data)
+
+
+ROUTES = [
+    (r'/identity', FakePlexHandler.get_identity),
+    (r'/:/websockets/notifications', FakePlexHandler.get_notifications),
+    (r'/activities', FakePlexHandler.get_activities),
+    (r'/library/sections', FakePlexHandler.get_sections),
+    (r'/library/sections/(\d+)/refresh', FakePlexHandler.get_section_scan),
+    (r'/library/sections/(\d+)/all', FakePlexHandler.get_all),
+    (r'/library/sections/(\d+)/folder', FakePlexHandler.get_folder),
+    (r'/library/metadata/([\d,]+)', FakePlexHandler.get_items),
+    (r'/library/metadata/(\d+)/refresh', FakePlexHandler.put_item_refresh),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--episodes', type=int, default=1000)
+    parser.add_argument('--tracks', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds to delay every response')
+    parser.add_argument('--error_rate', type=float, default=0, help='Fraction of requests to fail with a 500')
+    parser.add_argument('--port', type=int, default=32400)
+    args = parser.parse_args()
+
+    plex = FakePlex(args.movies, args.episodes, args.tracks, args.latency, args.error_rate)
+    print(f'Serving on {plex.start(args.port)}. Any token is accepted. Press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        plex.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Checks that the request governor (see ScanInPlexGovernor.py) holds its limits when many
+scanner processes run at once, e.g. after multi-selecting dozens of folders, against a fake
+Plex server (see fake_pms.py).
+
+Starts the given number of scanner processes at the same time, each scanning or refreshing
+several folders as concurrently as it's allowed to, and reports the most requests the server
+was ever handling at once. Runs once with the governor and once without for comparison, and
+fails if the governed run ever exceeded max_in_flight. A final run of two processes, with
+responses slower than slow_latency, shows the shared request rate backing off.
+
+Usage: python benchmarks/governor.py [--processes N] [--max_in_flight N] [--max_request_rate N] [--latency SECONDS]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_pms import FakePlex
+
+
+def run_child(args):
+    """Sends one process's worth of scans or refreshes"""
+    import ScanInPlexCommon as Common
+    Common.app_data_file = lambda filename: os.path.join(args.app_dir, filename)
+    from ScanInPlexScanner import Scanner
+
+    mappings, index = Scanner.load_config()
+    refresh = args.child % 2 == 1
+    if refresh:
+        batch = [{ 'directory' : f'D:\\TV\\Group {args.child:06d}\\Subgroup 01', 'refresh' : True }]
+    else:
+        batch = [{ 'directory' : f'D:\\Movies\\Item {args.child * 10 + i:07d}', 'refresh' : False } for i in range(8)]
+    scanner = Scanner(argparse.Namespace(directory=None, refresh_metadata=refresh, wait=False, fan_out=0))
+    scanner.process_batch(batch, mappings, index)
+
+
+def write_config(plex, host, app_dir, max_in_flight, max_request_rate, slow_latency):
+    from ScanInPlexIndex import RootIndex
+    sections = [{ 'section' : library.key, 'type' : library.type, 'paths' : [library.root] } for library in plex.libraries.values()]
+    config = {
+        'exe' : None,
+        'host' : host,
+        'token' : 'benchmark',
+        'sections' : sections,
+        'index' : RootIndex.build(sections).to_json(),
+        'scan_concurrency' : 8,
+        'refresh_concurrency' : 8,
+        'max_in_flight' : max_in_flight,
+        'max_request_rate' : max_request_rate,
+        'slow_latency' : slow_latency,
+        'circuit_threshold' : 1000,
+    }
+    with open(os.path.join(app_dir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+
+
+def run(plex, host, processes, max_in_flight, max_request_rate, slow_latency):
+    """Runs every process at once and returns (seconds, requests, peak in flight, governor state)"""
+    app_dir = tempfile.mkdtemp(prefix='ScanInPlexGovernor')
+    try:
+        write_config(plex, host, app_dir, max_in_flight, max_request_rate, slow_latency)
+        plex.reset_stats()
+        start = time.perf_counter()
+        children = [subprocess.Popen([sys.executable, __file__, '--child', str(i), '--app_dir', app_dir], stdout=subprocess.DEVNULL) for i in range(processes)]
+        failed = sum(1 for child in children if child.wait() != 0)
+        elapsed = time.perf_counter() - start
+        if failed > 0:
+            raise RuntimeError(f'{failed} scanner process(es) failed')
+
+        state = None
+        if max_in_flight > 0:
+            from ScanInPlexGovernor import Governor
+            state = Governor(os.path.join(app_dir, 'governor'), max_in_flight, max_request_rate, slow_latency).state(host.split('//')[1])
+        return elapsed, plex.requests, plex.peak_in_flight, state
+    finally:
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=20)
+    parser.add_argument('--max_in_flight', type=int, default=3)
+    parser.add_argument('--max_request_rate', type=float, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds to delay every response')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--app_dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child != None:
+        return run_child(args)
+
+    plex = FakePlex(movies=args.processes * 10, episodes=args.processes * 50, latency=args.latency)
+    host = plex.start()
+    print(f'{args.processes} processes, max_in_flight {args.max_in_flight}, max_request_rate {args.max_request_rate}, {args.latency * 1000:.0f}ms latency\n')
+    print(f'{"Run":<12} {"Time (s)":>10} {"Requests":>10} {"Peak in flight":>16} {"Final rate":>12}')
+    try:
+        # Slow responses drive the rate all the way down, so only use a couple of processes for that run
+        runs = [('ungoverned', args.processes, 0, 2), ('governed', args.processes, args.max_in_flight, 2), ('slow', 2, args.max_in_flight, args.latency / 2)]
+        for name, processes, max_in_flight, slow_latency in runs:
+            elapsed, requests, peak, state = run(plex, host, processes, max_in_flight, args.max_request_rate, slow_latency)
+            rate = f'{state["rate"]:.1f}/s' if state != None else '-'
+            print(f'{name:<12} {elapsed:>10.2f} {requests:>10} {peak:>16} {rate:>12}')
+            if max_in_flight > 0 and peak > max_in_flight:
+                print(f'FAILED: {peak} requests were in flight at once, but the limit is {max_in_flight}')
+                sys.exit(1)
+    finally:
+        plex.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Checks that the notification listener (see ScanInPlexNotifications.py) keeps the item index
+current against a fake Plex server (see fake_pms.py), which sends the same websocket
+notifications Plex does:
+  * an item that's added is indexed as soon as it's announced
+  * an item that's deleted is removed from the index
+  * items added while the connection was down are picked up by the resync after reconnecting
+  * a notification from a library config.json doesn't know about adds it to config.json
+
+Usage: python benchmarks/notifications.py [--movies N] [--timeout SECONDS]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_pms import FakePlex, Library
+
+
+def wait_for(condition, timeout):
+    """Waits until condition() holds, returning whether it did in time"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def check(name, condition):
+    print(f'{"OK" if condition else "FAILED"}: {name}')
+    if not condition:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--movies', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for each change to show up')
+    args = parser.parse_args()
+
+    app_dir = tempfile.mkdtemp(prefix='ScanInPlexNotifications')
+    import ScanInPlexCommon as Common
+    Common.app_data_file = lambda filename: os.path.join(app_dir, filename)
+    from ScanInPlexIndex import RootIndex
+    from ScanInPlexNotifications import NotificationListener
+    from ScanInPlexScanner import Scanner
+
+    plex = FakePlex(movies=args.movies)
+    host = plex.start()
+    listener = None
+    thread = None
+    try:
+        sections = [{ 'section' : library.key, 'type' : library.type, 'paths' : [library.root] } for library in plex.libraries.values()]
+        with open(os.path.join(app_dir, 'config.json'), 'w') as f:
+            json.dump({ 'exe' : None, 'host' : host, 'token' : 'benchmark', 'sections' : sections, 'index' : RootIndex.build(sections).to_json(), 'sections_ttl' : 0 }, f)
+
+        # The listener only keeps indexed sections current, so index the movies with a refresh first
+        mappings, index = Scanner.load_config()
+        Scanner(argparse.Namespace(directory=None, refresh_metadata=True, wait=False)).process_batch([{ 'directory' : 'D:\\Movies', 'refresh' : True }], mappings, index)
+
+        def indexed():
+            db = sqlite3.connect(os.path.join(app_dir, 'index.db'))
+            try:
+                return set(row[0] for row in db.execute("SELECT rating_key FROM items WHERE section='1'"))
+            finally:
+                db.close()
+
+        check('refresh indexed every movie', len(indexed()) == args.movies)
+
+        listener = NotificationListener(argparse.Namespace(quiet=True, directory=None, refresh_metadata=False))
+        thread = threading.Thread(target=listener.listen, daemon=True)
+        thread.start()
+        check('listener connected', wait_for(lambda: len(plex.listeners) > 0, args.timeout))
+
+        added = plex.add_item('1')
+        check('added item is indexed', wait_for(lambda: added in indexed(), args.timeout))
+
+        removed = plex.remove_item('1')
+        check('removed item is dropped', wait_for(lambda: removed not in indexed(), args.timeout))
+
+        plex.disconnect()
+        check('listener disconnected', wait_for(lambda: len(plex.listeners) == 0, args.timeout))
+        missed = [plex.add_item('1'), plex.add_item('1')] # Nobody's listening, so these are only found by resyncing
+        check('items added while disconnected are indexed after reconnecting', wait_for(lambda: set(missed) <= indexed(), args.timeout + 5))
+        check('index matches the server', len(indexed()) == plex.libraries['1'].count)
+
+        plex.add(Library('4', 'movie', 'movie', 'D:\\Films', 10))
+        plex.notify_timeline(plex.libraries['4'], plex.libraries['4'].key_base, 5)
+        def configured():
+            with open(os.path.join(app_dir, 'config.json')) as f:
+                return '4' in [section['section'] for section in json.load(f)['sections']]
+        check('new library is added to config.json', wait_for(configured, args.timeout))
+    finally:
+        if listener != None:
+            listener.stop()
+            thread.join(args.timeout)
+        plex.stop()
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
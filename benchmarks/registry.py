@@ -0,0 +1,72 @@
+"""
+Checks that configuration only touches the registry when something actually changed, by
+diffing the context menu entries Configure wants against an in-memory registry
+(Registry.MemoryBackend) and applying the result, for:
+  * a first install, which adds every key
+  * rerunning configuration unchanged, which changes nothing
+  * adding a library root, which only updates AppliesTo
+  * turning off Refresh Metadata, which removes its keys and leaves Scan in Plex alone
+
+Runs anywhere, since nothing touches the real registry.
+
+Usage: python benchmarks/registry.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ScanInPlexConfiguration import Configure
+import ScanInPlexRegistry as Registry
+
+
+def make_configure(refresh):
+    """A Configure with everything the registry state depends on filled in, so nothing is looked up or prompted for"""
+    configure = Configure.__new__(Configure)
+    configure.refresh = refresh
+    configure.drives = {}
+    configure.pms_path = 'C:\\Program Files\\Plex\\Plex Media Server\\Plex Media Server.exe'
+    configure.pyw_path = 'C:\\Python\\pythonw.exe'
+    configure.output_path = 'C:\\Users\\Plex\\AppData\\Local\\ScanInPlex'
+    return configure
+
+
+def check(name, condition):
+    print(f'{"OK" if condition else "FAILED"}: {name}')
+    if not condition:
+        sys.exit(1)
+
+
+def main():
+    sections = [{ 'section' : '1', 'type' : 'movie', 'paths' : ['D:\\Movies'] }, { 'section' : '2', 'type' : 'show', 'paths' : ['D:\\TV'] }]
+    scan_key, refresh_key = Registry.MENU_KEYS
+    registry = Registry.MemoryBackend()
+
+    desired = make_configure(True).get_registry_state(sections)
+    changes = Registry.diff(desired, registry)
+    check('first install adds every key', set(changes) == set(desired))
+    registry.apply(changes)
+    check('first install leaves the desired state', all(registry.read(key) == values for key, values in desired.items()))
+
+    changes = Registry.diff(make_configure(True).get_registry_state(sections), registry)
+    check('unchanged rerun has nothing to change', changes == {})
+
+    sections[1]['paths'].append('E:\\TV')
+    changes = Registry.diff(make_configure(True).get_registry_state(sections), registry)
+    check('new root only changes AppliesTo', changes.keys() == { scan_key, refresh_key } and all(list(values) == ['AppliesTo'] for values in changes.values()))
+    registry.apply(changes)
+    check('new root is in AppliesTo', 'E:\\TV' in registry.read(scan_key)['AppliesTo'])
+
+    changes = Registry.diff(make_configure(False).get_registry_state(sections), registry)
+    check('turning off refresh only deletes its keys', changes == { refresh_key : None, f'{refresh_key}\\command' : None })
+    registry.apply(changes)
+    check('refresh entry is gone', registry.read(refresh_key) == None and registry.read(f'{refresh_key}\\command') == None)
+    check('scan entry is untouched', registry.read(scan_key) != None and registry.read(f'{scan_key}\\command') != None)
+
+    changes = Registry.diff(make_configure(False).get_registry_state(sections), registry)
+    check('rerun after removal has nothing to change', changes == {})
+    check('every change was applied in one batch per run', len(registry.applied) == 3)
+
+
+if __name__ == '__main__':
+    main()
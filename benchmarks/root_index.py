@@ -0,0 +1,127 @@
+"""
+Microbenchmark for the section root index used by ScanInPlexScanner.
+
+Compares the precompiled RootIndex against the original linear search over every
+section's roots, and times loading the serialized index, which every click pays. Also
+checks and times reducing a messy set of roots (duplicates, case and separator variants,
+nested roots) to the minimal set used for the context menu's AppliesTo expression.
+
+Usage: python benchmarks/root_index.py [-n ROOTS] [-s SECTIONS] [-l LOOKUPS]
+"""
+
+import argparse
+import json
+import ntpath
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ScanInPlexIndex import RootIndex, minimal_roots, path_key
+
+
+def make_sections(root_count, section_count):
+    """Generates sections with roots spread across a handful of NAS shares and drives"""
+    rand = random.Random(root_count)
+    sections = [{ 'section' : str(i + 1), 'type' : 'movie', 'paths' : [] } for i in range(section_count)]
+    for i in range(root_count):
+        if i % 3 == 0:
+            root = f'\\\\NAS{i % 7}\\Share{i % 13}\\Media\\Library{i}'
+        else:
+            root = f'{"DEFGHIJ"[i % 7]}:\\Media\\Group{i % 50}\\Library{i}'
+        sections[rand.randrange(section_count)]['paths'].append(root)
+    return sections
+
+
+def make_queries(sections, count):
+    rand = random.Random(count)
+    roots = [path for section in sections for path in section['paths']]
+    queries = []
+    for i in range(count):
+        root = rand.choice(roots)
+        if i % 4 == 0:
+            queries.append(root + '2\\Missing') # Partial component match, should miss
+        else:
+            queries.append(root + ''.join(f'\\Folder {rand.randrange(100)}' for _ in range(rand.randrange(1, 5))))
+    return queries
+
+
+def make_variants(sections):
+    """Returns every root along with the redundant spellings configuration has to cope with"""
+    rand = random.Random(len(sections))
+    paths = []
+    for path in [path for section in sections for path in section['paths']]:
+        paths.append(path)
+        variant = rand.randrange(6)
+        if variant == 0:
+            paths.append(path.upper())
+        elif variant == 1:
+            paths.append(path + '\\')
+        elif variant == 2:
+            paths.append(path.replace('\\', '/'))
+        elif variant == 3:
+            paths.append(f'{path}\\Extras\\..\\Subfolder {rand.randrange(10)}') # Nested
+        elif variant == 4:
+            paths.append(f'{path}\\.\\..\\{ntpath.basename(path)}') # The same root, the long way around
+    rand.shuffle(paths)
+    return paths
+
+
+def brute_force_minimal(paths):
+    """Keys of the roots that aren't under (or the same as) any other root, comparing every pair"""
+    keys = set(path_key(path) for path in paths)
+    return set(key for key in keys if not any(key.startswith(other + '\\') for other in keys))
+
+
+def linear_lookup(sections, directory):
+    """The lookup ScanInPlexScanner used before the index was introduced"""
+    dir_lower = directory.lower()
+    for section in sections:
+        for path in [p.lower() for p in section['paths']]:
+            if dir_lower.startswith(path) and (len(dir_lower) == len(path) or dir_lower[len(path)] == '\\'):
+                return section
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--roots', type=int, default=10000)
+    parser.add_argument('-s', '--sections', type=int, default=40)
+    parser.add_argument('-l', '--lookups', type=int, default=1000)
+    args = parser.parse_args()
+
+    sections = make_sections(args.roots, args.sections)
+    queries = make_queries(sections, args.lookups)
+
+    build_time = timeit.timeit(lambda: RootIndex.build(sections), number=1)
+    serialized = json.dumps({ 'sections' : sections, 'index' : RootIndex.build(sections).to_json() })
+    load_runs = 20
+    load_time = timeit.timeit(lambda: RootIndex(json.loads(serialized)['index']), number=load_runs) / load_runs
+
+    index = RootIndex.build(sections)
+    for query in queries:
+        expected = linear_lookup(sections, query)
+        found = index.lookup(query)
+        assert (expected == None) == (found == None), query
+
+    index_time = timeit.timeit(lambda: [index.lookup(q) for q in queries], number=5) / (5 * len(queries))
+    linear_runs = max(1, 20000 // args.roots)
+    linear_time = timeit.timeit(lambda: [linear_lookup(sections, q) for q in queries[:50]], number=linear_runs) / (linear_runs * 50)
+
+    print(f'{args.roots} roots across {args.sections} sections')
+    print(f'  Index build:        {build_time * 1000:10.2f} ms')
+    print(f'  config.json load:   {load_time * 1000:10.2f} ms ({len(serialized) / 1024:.0f} KiB)')
+    print(f'  Index lookup:       {index_time * 1e6:10.2f} us')
+    print(f'  Linear lookup:      {linear_time * 1e6:10.2f} us')
+
+    variants = make_variants(sections)
+    minimal = minimal_roots(variants)
+    assert set(path_key(path) for path in minimal) == brute_force_minimal(variants)
+    assert len(minimal) == len(set(path_key(path) for path in minimal))
+    minimal_time = timeit.timeit(lambda: minimal_roots(variants), number=1)
+    print(f'  Minimal roots:      {minimal_time * 1000:10.2f} ms ({len(variants)} roots and variants -> {len(minimal)})')
+
+
+if __name__ == '__main__':
+    main()
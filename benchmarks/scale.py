@@ -0,0 +1,143 @@
+"""
+Measures scanner operations against a fake Plex server (see fake_pms.py) with synthetic
+libraries of any size, entirely offline.
+
+Each operation runs in a fresh interpreter against a throwaway app data folder, and reports:
+  * wall time of the operation itself (excluding interpreter startup)
+  * the number of requests the server received, and the number of bytes it sent
+  * the peak RSS of the process
+
+Refreshes use the given refresh strategies (see Scanner.refresh), each in turn, to compare them.
+
+Usage: python benchmarks/scale.py [--movies N] [--episodes N] [--tracks N] [--latency SECONDS]
+                                  [--error_rate FRACTION] [--page_size N] [--strategies STRATEGY,...]
+                                  [--refuse_forced] [OPERATION ...]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_pms import FakePlex
+
+# name : (section key the operation needs, directory, whether it's a refresh)
+OPERATIONS = {
+    'scan' : ('2', 'D:\\TV\\Group 000001', False),
+    'refresh-movie' : ('1', 'D:\\Movies\\Item 0000001', True),
+    'refresh-season' : ('2', 'D:\\TV\\Group 000001\\Subgroup 02', True),
+    'refresh-show' : ('2', 'D:\\TV\\Group 000001', True),
+    'refresh-artist' : ('3', 'D:\\Music\\Group 000001', True),
+    'refresh-root-cold' : ('2', 'D:\\TV', True),
+    'refresh-root-warm' : ('2', 'D:\\TV', True),
+}
+
+
+def run_child(args):
+    """Runs a single operation in this process and prints its measurements as JSON"""
+    import resource
+    import time
+    import ScanInPlexCommon as Common
+    Common.app_data_file = lambda filename: os.path.join(args.app_dir, filename)
+    from ScanInPlexScanner import Scanner
+
+    start = time.perf_counter()
+    if args.child == 'sections':
+        from ScanInPlexConfiguration import Configure
+        configure = Configure.__new__(Configure)
+        configure.host = args.host
+        configure.token = 'benchmark'
+        configure.servers = [{ 'host' : args.host, 'token' : 'benchmark' }]
+        configure.discovery_timeout = None
+        configure.quiet = True
+        configure.get_library_mappings()
+    else:
+        _, directory, refresh = OPERATIONS[args.child]
+        mappings, index = Scanner.load_config()
+        scanner = Scanner(argparse.Namespace(directory=directory, refresh_metadata=refresh, wait=False, refresh_strategy=args.strategy))
+        scanner.process_batch([{ 'directory' : directory, 'refresh' : refresh }], mappings, index)
+
+    elapsed = time.perf_counter() - start
+    print(json.dumps({ 'seconds' : elapsed, 'rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss }))
+
+
+def write_config(plex, host, app_dir, page_size):
+    from ScanInPlexIndex import RootIndex
+    sections = [{ 'section' : library.key, 'type' : library.type, 'paths' : [library.root] } for library in plex.libraries.values()]
+    config = {
+        'exe' : 'Plex Media Scanner.exe',
+        'host' : host,
+        'token' : 'benchmark',
+        'sections' : sections,
+        'index' : RootIndex.build(sections).to_json(),
+        'page_size' : page_size,
+    }
+    with open(os.path.join(app_dir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('operations', nargs='*', help=f'Operations to run (default: all). Any of sections, {", ".join(OPERATIONS)}')
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--episodes', type=int, default=10000)
+    parser.add_argument('--tracks', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0, help='Seconds to delay every response')
+    parser.add_argument('--error_rate', type=float, default=0, help='Fraction of requests to fail with a 500')
+    parser.add_argument('--page_size', type=int, default=500)
+    parser.add_argument('--strategies', type=lambda value: value.split(','), default=['per-item'], help='Comma-separated refresh strategies to run each refresh with (default: per-item)')
+    parser.add_argument('--refuse_forced', action='store_true', help='Have the server reject forced refreshes')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--host', help=argparse.SUPPRESS)
+    parser.add_argument('--strategy', help=argparse.SUPPRESS)
+    parser.add_argument('--app_dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    plex = FakePlex(args.movies, args.episodes, args.tracks, args.latency, args.error_rate)
+    plex.refuse_forced = args.refuse_forced
+    host = plex.start()
+    # Each strategy gets its own app data folder, and so its own item index, so that a warm
+    # refresh always runs on the index left behind by the same strategy's cold refresh
+    app_dirs = { strategy : tempfile.mkdtemp(prefix='ScanInPlexScale') for strategy in ['-'] + args.strategies }
+    for app_dir in app_dirs.values():
+        write_config(plex, host, app_dir, args.page_size)
+
+    operations = args.operations or ['sections'] + list(OPERATIONS)
+    print(f'{args.movies} movies, {args.episodes} episodes, {args.tracks} tracks, {args.latency * 1000:.0f}ms latency, {args.error_rate:.0%} errors\n')
+    print(f'{"Operation":<20} {"Strategy":<12} {"Time (s)":>10} {"Requests":>10} {"Sent (KiB)":>12} {"Peak RSS (MiB)":>16}')
+    try:
+        for operation in operations:
+            if operation != 'sections' and OPERATIONS[operation][0] not in plex.libraries:
+                continue
+
+            refresh = operation != 'sections' and OPERATIONS[operation][2]
+            for strategy in args.strategies if refresh else ['-']:
+                app_dir = app_dirs[strategy]
+                if operation == 'refresh-root-cold' and os.path.exists(os.path.join(app_dir, 'index.db')):
+                    os.remove(os.path.join(app_dir, 'index.db'))
+
+                plex.reset_stats()
+                result = subprocess.run([sys.executable, __file__, '--child', operation, '--host', host, '--app_dir', app_dir, '--strategy', strategy], capture_output=True, text=True)
+                if result.returncode != 0:
+                    print(f'{operation:<20} {strategy:<12} failed:\n{result.stderr}')
+                    continue
+
+                stats = json.loads(result.stdout.strip().splitlines()[-1])
+                print(f'{operation:<20} {strategy:<12} {stats["seconds"]:>10.3f} {plex.requests:>10} {plex.bytes_sent / 1024:>12.1f} {stats["rss_kb"] / 1024:>16.1f}')
+    finally:
+        plex.stop()
+        for app_dir in app_dirs.values():
+            shutil.rmtree(app_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
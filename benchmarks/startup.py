@@ -0,0 +1,136 @@
+"""
+Measures the cold start cost of the context menu handler, i.e. what a single click in
+Explorer pays before anything happens.
+
+Each scenario runs ScanInPlexScanner.py in a fresh interpreter, the same way the context
+menu does, against a throwaway copy of the scanner and a stub Plex server:
+
+  no-match  The directory isn't in any library, so the scanner should exit immediately
+  match     The directory is in a library, so the scanner sends a single scan request
+  refresh   The directory is in a library and its metadata is refreshed
+
+For each scenario it reports the median wall clock time and the slowest top-level imports
+according to python -X importtime.
+
+Usage: python benchmarks/startup.py [-n RUNS] [-i IMPORTS]
+"""
+
+import argparse
+import http.server
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+from ScanInPlexIndex import RootIndex
+
+SECTIONS = [{ 'section' : '1', 'type' : 'movie', 'paths' : ['D:\\Movies'] }]
+
+SCENARIOS = {
+    'no-match' : ['-d', 'D:\\Documents\\Not a library'],
+    'match' : ['-d', 'D:\\Movies\\Some Movie (2020)'],
+    'refresh' : ['-r', '-d', 'D:\\Movies\\Some Movie (2020)'],
+}
+
+class StubPlex(http.server.BaseHTTPRequestHandler):
+    """Answers just enough requests for a scan or a refresh of a single movie to succeed"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        item = { 'ratingKey' : '1', 'updatedAt' : 1, 'Media' : [{ 'Part' : [{ 'file' : 'D:\\Movies\\Some Movie (2020)\\movie.mkv' }] }] }
+        self.reply({ 'MediaContainer' : { 'totalSize' : 1, 'Metadata' : [item] } })
+
+    def do_PUT(self):
+        self.reply({})
+
+    def reply(self, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_app_dir(host):
+    """Mirrors what configuration leaves in %LOCALAPPDATA%\\ScanInPlex"""
+    app_dir = tempfile.mkdtemp(prefix='ScanInPlexStartup')
+    for name in os.listdir(REPO):
+        if name.startswith('ScanInPlex') and name.endswith('.py'):
+            shutil.copy(os.path.join(REPO, name), app_dir)
+
+    config = {
+        'exe' : 'Plex Media Scanner.exe',
+        'host' : host,
+        'token' : 'benchmark',
+        'sections' : SECTIONS,
+        'index' : RootIndex.build(SECTIONS).to_json(),
+        # Don't let the broker's debounce window dominate the measurement
+        'broker_window' : 0,
+        'broker_max_wait' : 0,
+    }
+    with open(os.path.join(app_dir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    return app_dir
+
+
+def time_runs(scanner, args, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, scanner] + args, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def slowest_imports(scanner, args, count):
+    """Returns the (cumulative microseconds, module) of the slowest top-level imports"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', scanner] + args, check=True, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented, and are already included in their parent's cumulative time
+        if not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('-i', '--imports', type=int, default=8, help='Number of slow imports to show per scenario')
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubPlex)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app_dir = make_app_dir(f'http://127.0.0.1:{server.server_port}')
+    scanner = os.path.join(app_dir, 'ScanInPlexScanner.py')
+
+    baseline = statistics.median(time_runs('-c', ['pass'], args.runs))
+    print(f'Bare interpreter: {baseline * 1000:8.1f} ms\n')
+
+    try:
+        for name, scenario_args in SCENARIOS.items():
+            times = time_runs(scanner, scenario_args, args.runs)
+            print(f'{name}: {statistics.median(times) * 1000:8.1f} ms median, {max(times) * 1000:8.1f} ms max')
+            for cumulative, module in slowest_imports(scanner, scenario_args, args.imports):
+                print(f'  {cumulative / 1000:8.1f} ms  {module}')
+            print()
+    finally:
+        server.shutdown()
+        shutil.rmtree(app_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()